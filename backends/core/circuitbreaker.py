@@ -0,0 +1,85 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Circuit breakers for external services shared by all instances through
+memcache.
+
+A breaker opens after a number of consecutive failed calls to its service and
+stays open for a while, so that workers are deferred instead of hammering a
+degraded endpoint. Once the open period is over, a single failed call opens
+the breaker again, while a successful call closes it.
+"""
+
+import time
+
+from google.appengine.api import memcache
+
+
+# Settings of breakers as tuples of two elements: 0) number of consecutive
+# failures to open a breaker, and 1) number of seconds it stays open.
+SERVICES = {
+    'ga_v3': (10, 60),
+    'ga_v4': (10, 60),
+    'bigquery': (10, 60),
+    'gcs': (10, 60),
+    'mp': (20, 30),
+    'ml': (10, 60),
+}
+
+_NAMESPACE = 'circuitbreaker'
+
+
+def _failures_key(service):
+  return 'failures:%s' % service
+
+
+def _opened_at_key(service):
+  return 'opened_at:%s' % service
+
+
+def retry_after(service):
+  """Returns 0 if the breaker is closed, otherwise seconds until it half-opens.
+
+  Args:
+    service: Name of the service, one of SERVICES keys.
+  """
+  opened_at = memcache.get(_opened_at_key(service), namespace=_NAMESPACE)
+  if opened_at is None:
+    return 0
+  _, open_time = SERVICES[service]
+  return max(opened_at + open_time - time.time(), 0)
+
+
+def record_success(service):
+  """Closes the breaker of a service after a successful call."""
+  memcache.delete(_failures_key(service), namespace=_NAMESPACE)
+
+
+def record_failure(service):
+  """Counts a failed call and opens the breaker if there were too many.
+
+  Returns:
+    True if the breaker has been opened.
+  """
+  threshold, open_time = SERVICES[service]
+  client = memcache.Client()
+  failures = client.incr(_failures_key(service), namespace=_NAMESPACE,
+                         initial_value=0)
+  if failures is None or failures < threshold:
+    return False
+  client.set(_opened_at_key(service), time.time(), time=open_time,
+             namespace=_NAMESPACE)
+  # Next failure opens the breaker again once it has half-opened.
+  client.set(_failures_key(service), threshold - 1, namespace=_NAMESPACE)
+  return True
@@ -12,6 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+import json
+import sys
+import time
+
 from google.cloud.logging import Client
 
 from core.app_data import SA_DATA, SA_FILE
@@ -25,3 +30,50 @@ else:
 
 logger_name = 'crmintapplogger'
 logger = client.logger(logger_name)
+
+
+class LogBuffer(object):
+  """Collects structured log entries and writes them in batches.
+
+  Entries are written when the buffer is full, when the oldest entry is too
+  old, and on explicit flush. Entries go both to Cloud Logging and to the
+  job_logs table the pipeline logs view is served from. Entries that fail to
+  be written to Cloud Logging are dumped to stderr, so that they end up in the
+  request log at least.
+  """
+
+  MAX_ENTRIES = 50
+  MAX_AGE = 5  # seconds
+
+  def __init__(self):
+    self._entries = []
+    self._oldest_entry_at = None
+
+  def log_struct(self, info):
+    if not self._entries:
+      self._oldest_entry_at = time.time()
+    self._entries.append((info, datetime.utcnow()))
+    if (len(self._entries) >= self.MAX_ENTRIES
+        or time.time() - self._oldest_entry_at >= self.MAX_AGE):
+      self.flush()
+
+  def flush(self):
+    if not self._entries:
+      return
+    entries, self._entries = self._entries, []
+    batch = logger.batch()
+    for info, timestamp in entries:
+      batch.log_struct(info, timestamp=timestamp)
+    try:
+      batch.commit()
+    except Exception as e:  # pylint: disable=broad-except
+      sys.stderr.write('Failed to write %i log entries: %s\n' % (
+          len(entries), e))
+      for info, _ in entries:
+        sys.stderr.write('%s\n' % json.dumps(info))
+    try:
+      from core.models import JobLog
+      JobLog.add_entries(entries)
+    except Exception as e:  # pylint: disable=broad-except
+      sys.stderr.write('Failed to store %i log entries: %s\n' % (
+          len(entries), e))
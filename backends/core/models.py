@@ -12,22 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
 from datetime import datetime
+import hashlib
 import json
 import re
 import uuid
+from croniter import croniter
 from google.appengine.api import taskqueue
 from simpleeval import simple_eval
 from simpleeval import InvalidExpression
 from sqlalchemy import Column
 from sqlalchemy import Integer
+from sqlalchemy import Float
 from sqlalchemy import String
 from sqlalchemy import DateTime
 from sqlalchemy import Text
 from sqlalchemy import Boolean
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import load_only
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import set_committed_value
 from core.database import BaseModel
 from core import inline
 from core.mailers import NotificationMailer
@@ -56,10 +66,29 @@ class Pipeline(BaseModel):
   run_on_schedule = Column(Boolean, nullable=False, default=False)
   schedules = relationship('Schedule', lazy='dynamic')
   params = relationship('Param', lazy='dynamic', order_by='asc(Param.name)')
+  priority = Column(String(50), nullable=False, default='normal')
+  max_concurrent_tasks = Column(Integer)
+
+  # Task queues serving pipelines of each priority. See queue.yaml.
+  PRIORITY_QUEUES = {
+      'high': 'high-priority',
+      'normal': 'default',
+      'low': 'bulk',
+  }
 
   def __init__(self, name=None):
     self.name = name
 
+  @validates('run_on_schedule')
+  def validate_run_on_schedule(self, key, run_on_schedule):
+    if run_on_schedule and not self.run_on_schedule and self.id is not None:
+      # Schedules aren't advanced while the pipeline is off schedule. Let the
+      # cron handler set them to their next fire time, so that fire times
+      # missed in the meantime don't start the pipeline right away.
+      Schedule.where(pipeline_id=self.id, is_valid=True).update(
+          {Schedule.next_run_at: None}, synchronize_session=False)
+    return run_on_schedule
+
   @property
   def state(self):
     return self.status
@@ -68,6 +97,10 @@ class Pipeline(BaseModel):
   def has_jobs(self):
     return self.jobs.count() > 0
 
+  @property
+  def queue_name(self):
+    return self.PRIORITY_QUEUES.get(self.priority, 'default')
+
   @property
   def recipients(self):
     if self.emails_for_notifications:
@@ -81,6 +114,8 @@ class Pipeline(BaseModel):
       if key == 'run_on_schedule':
         self.__setattr__(key, value == 'True')
         continue
+      if key == 'priority' and value is None:
+        continue
       self.__setattr__(key, value)
 
   def save_relations(self, relations):
@@ -172,6 +207,9 @@ class Pipeline(BaseModel):
     NotificationMailer().finished_pipeline(self)
 
   def import_data(self, data):
+    self.priority = data.get('priority', 'normal')
+    self.max_concurrent_tasks = data.get('max_concurrent_tasks')
+    self.save()
     self.assign_params(data['params'])
     self.assign_schedules(data['schedules'])
     job_mapping = {}
@@ -228,6 +266,12 @@ class Job(BaseModel):
   enqueued_workers_count = Column(Integer, default=0)
   succeeded_workers_count = Column(Integer, default=0)
   failed_workers_count = Column(Integer, default=0)
+  retries_count = Column(Integer, default=0)
+  backoff_seconds = Column(Float, default=0)
+
+  # Worker params serialized to a longer string are stored in ParamsBlob table
+  # and passed to the task by reference.
+  MAX_INLINE_PARAMS_SIZE = 10 * 1024
 
   def __init__(self, name=None, worker_class=None, pipeline_id=None):
     self.name = name
@@ -247,6 +291,12 @@ class Job(BaseModel):
     param_ids = [p.id for p in self.params.all()]
     if param_ids:
       Param.destroy(*param_ids)
+
+    with self.session.begin(subtransactions=True):
+      for execution in TaskExecution.where(
+          job_id=self.id, status__in=TaskExecution.IN_FLIGHT_STATUSES).all():
+        TaskSlot.release(execution.slots)
+      TaskExecution.where(job_id=self.id).delete(synchronize_session=False)
     self.delete()
 
   def get_ready(self):
@@ -256,8 +306,9 @@ class Job(BaseModel):
       for param in self.params:
         _ = param.val  # NOQA
     except (InvalidExpression, TypeError) as e:
-      from core.logging import logger
-      logger.log_struct({
+      from core.logging import LogBuffer
+      log_buffer = LogBuffer()
+      log_buffer.log_struct({
           'labels': {
               'pipeline_id': self.pipeline_id,
               'job_id': self.id,
@@ -266,6 +317,7 @@ class Job(BaseModel):
           'log_level': 'ERROR',
           'message': 'Bad job param "%s": %s' % (param.label, e),
       })
+      log_buffer.flush()
       return False
     self.update(status='waiting', status_changed_at=datetime.now())
     return True
@@ -299,6 +351,8 @@ class Job(BaseModel):
     self.enqueued_workers_count = 0
     self.succeeded_workers_count = 0
     self.failed_workers_count = 0
+    self.retries_count = 0
+    self.backoff_seconds = 0
     self.status = 'running'
     self.status_changed_at = datetime.now()
     worker_params = dict([(p.name, p.val) for p in self.params])
@@ -313,26 +367,98 @@ class Job(BaseModel):
       return True
     return False
 
-  def enqueue(self, worker_class, worker_params, delay=0):
+  def enqueue(self, worker_class, worker_params, delay=0,
+              parent_task_name=None, position=0, inline=False):
+    """Adds a worker task to the queue.
+
+    With inline set, the task is recorded as running instead, for the caller
+    to run the worker in-process, and its ledger entry is returned. The entry
+    keeps task params, so the task can still be dispatched to the queue.
+
+    NB: the task takes its concurrency slots, is recorded in the ledger and
+        is added to the queue in a single transaction, so a failure on the
+        way leaves no entry or slot behind.
+    """
     if self.status != 'running':
       return False
+    task_params = self._get_task_params(worker_class, worker_params)
+    task_name = self._get_task_name(parent_task_name, position)
+    if parent_task_name is not None:
+      execution = TaskExecution.where(task_name=task_name).first()
+      if execution is not None:
+        if inline and execution.status == 'running' and execution.payload:
+          # Left running in-process by a request that died, run it again.
+          return execution
+        # Already buffered, enqueued, running or finished.
+        return None
+    execution = TaskExecution(
+        task_name=task_name,
+        parent_task_name=parent_task_name,
+        pipeline_id=self.pipeline_id,
+        job=self,
+        worker_class=worker_class,
+        status='enqueued')
+    limits = self.get_slot_limits(worker_class)
+    task = None
+    with self.session.begin(subtransactions=True):
+      if TaskSlot.acquire(limits) is not None:
+        # Buffer the task until one of the running tasks finishes.
+        execution.fill(status='pending', payload=json.dumps(task_params),
+                       countdown=delay)
+      else:
+        execution.slots = TaskSlot.join(limits)
+        if inline:
+          execution.fill(status='running', payload=json.dumps(task_params))
+      execution.save()
+      if execution.status == 'enqueued':
+        task = execution.dispatch(task_params, delay)
+      self.save()
+      # Workers of the same job enqueue tasks concurrently.
+      Job.query.filter(Job.id == self.id).update(
+          {Job.enqueued_workers_count: Job.enqueued_workers_count + 1},
+          synchronize_session=False)
+    self.session.expire(self, ['enqueued_workers_count'])
+    if execution.status == 'running':
+      return execution
+    return task
+
+  def _get_task_params(self, worker_class, worker_params):
     task_params = {
         'job_id': self.id,
         'worker_class': worker_class,
-        'worker_params': json.dumps(worker_params),
     }
+    payload = json.dumps(worker_params)
+    if len(payload) > self.MAX_INLINE_PARAMS_SIZE:
+      task_params['worker_params_ref'] = ParamsBlob.store(payload)
+    else:
+      task_params['worker_params'] = payload
+    return task_params
+
+  def _get_task_name(self, parent_task_name, position):
     task_name = '%s_%s_%s' % (self.pipeline.name, self.name, self.worker_class)
-    escaped_task_name = re.sub(r'[^-_0-9a-zA-Z]', '-', task_name)
-    unique_task_name = '%s_%s' % (escaped_task_name, str(uuid.uuid4()))
-    task = taskqueue.add(
-        target='job-service',
-        name=unique_task_name,
-        url='/task',
-        params=task_params,
-        countdown=delay)
-    self.enqueued_workers_count += 1
-    self.save()
-    return task
+    escaped_task_name = re.sub(r'[^-_0-9a-zA-Z]', '-', task_name)[:200]
+    if parent_task_name is None:
+      task_uuid = uuid.uuid4()
+    else:
+      # Tasks enqueued by a worker get names derived from the parent task name,
+      # so that a redelivered parent task enqueues the very same tasks again
+      # and they are rejected by the queue as duplicates.
+      task_uuid = uuid.uuid5(uuid.NAMESPACE_URL,
+                             '%s/%i' % (parent_task_name, position))
+    return '%s_%s' % (escaped_task_name, str(task_uuid))
+
+  def get_slot_limits(self, worker_class):
+    """Returns (slot name, limit) pairs of caps a worker class falls under."""
+    limits = []
+    max_pipeline_tasks = self.pipeline.max_concurrent_tasks
+    if max_pipeline_tasks:
+      limits.append(('pipeline:%i' % self.pipeline_id, max_pipeline_tasks))
+    from core import workers
+    worker = getattr(workers, worker_class or '', None)
+    max_worker_tasks = getattr(worker, 'MAX_CONCURRENT_TASKS', None)
+    if max_worker_tasks:
+      limits.append(('worker:%s' % worker_class, max_worker_tasks))
+    return limits
 
   @property
   def finished_workers_count(self):
@@ -344,28 +470,53 @@ class Job(BaseModel):
         job.start()
     self.pipeline.job_finished()
 
-  def worker_succeeded(self):
-    self.succeeded_workers_count += 1
-    if self.finished_workers_count >= self.enqueued_workers_count:
-      if self.failed_workers_count < 1:
-        self.status = 'succeeded'
-      else:
-        self.status = 'failed'
-      self.status_changed_at = datetime.now()
-      self.save()
-      self._start_dependent_jobs()
-    else:
-      self.save()
+  def add_retry_stats(self, retries_count, backoff_seconds):
+    """Adds retries made by a worker to the job totals.
 
-  def worker_failed(self):
-    self.failed_workers_count += 1
-    if self.finished_workers_count >= self.enqueued_workers_count:
-      self.status = 'failed'
-      self.status_changed_at = datetime.now()
+    NB: counters are incremented in SQL, as workers of the same job report
+        their stats concurrently.
+    """
+    if not retries_count and not backoff_seconds:
+      return
+    Job.where(id=self.id).update({
+        Job.retries_count: Job.retries_count + retries_count,
+        Job.backoff_seconds: Job.backoff_seconds + backoff_seconds,
+    }, synchronize_session=False)
+
+  def worker_succeeded(self, execution=None):
+    self._worker_finished('succeeded', execution)
+
+  def worker_failed(self, execution=None):
+    self._worker_finished('failed', execution)
+
+  def _worker_finished(self, status, execution):
+    """Counts a worker outcome and finishes the job after its last worker.
+
+    NB: the ledger entry of the task is moved to its final status in the same
+        transaction as the counters are updated, so that a request dying in
+        between can't leave the outcome recorded but not counted.
+    """
+    with self.session.begin(subtransactions=True):
+      if execution is not None and not execution.finish(status):
+        # Already counted by an earlier delivery of the task.
+        return
+      # Workers of the same job finish concurrently.
+      locked = Job.query.filter(Job.id == self.id).with_for_update()
+      locked.populate_existing().one()
+      if status == 'succeeded':
+        self.succeeded_workers_count += 1
+      else:
+        self.failed_workers_count += 1
+      finished = self.finished_workers_count >= self.enqueued_workers_count
+      if finished:
+        if self.failed_workers_count < 1:
+          self.status = 'succeeded'
+        else:
+          self.status = 'failed'
+        self.status_changed_at = datetime.now()
       self.save()
+    if finished:
       self._start_dependent_jobs()
-    else:
-      self.save()
 
   def assign_attributes(self, attributes):
     for key, value in attributes.iteritems():
@@ -551,9 +702,82 @@ class Schedule(BaseModel):
   id = Column(Integer, primary_key=True, autoincrement=True)
   pipeline_id = Column(Integer, ForeignKey('pipelines.id'))
   cron = Column(String(255))
+  # Next time the schedule fires, UTC. NULL for an invalid cron string.
+  next_run_at = Column(DateTime, index=True)
+  # False for an invalid cron string, so that the schedule is left alone
+  # until the cron string is changed.
+  is_valid = Column(Boolean, nullable=False, default=True)
+  # Fire time of the latest pipeline start made by the schedule, UTC.
+  last_run_at = Column(DateTime)
 
   pipeline = relationship('Pipeline', foreign_keys=[pipeline_id])
 
+  # Starts of pipelines due at the same time are spread over shards, each
+  # shard being delayed by a few more seconds than the previous one.
+  START_SHARDS = 10
+  START_SHARD_DELAY = 3
+
+  @validates('cron')
+  def validate_cron(self, key, cron):
+    self.next_run_at = self.get_next_run_at(cron=cron)
+    self.is_valid = self.next_run_at is not None
+    return cron
+
+  def advance(self, now):
+    """Moves the schedule to its first fire time after a moment."""
+    next_run_at = self.get_next_run_at(now)
+    self.update(next_run_at=next_run_at, is_valid=next_run_at is not None)
+
+  def get_next_run_at(self, after=None, cron=None):
+    """Returns the first fire time strictly after a moment, now by default.
+
+    Args:
+      after: UTC datetime to start from.
+      cron: Cron string to use instead of the current one.
+    """
+    if after is None:
+      after = datetime.utcnow()
+    timestamp = calendar.timegm(after.timetuple())
+    try:
+      next_timestamp = croniter(cron or self.cron, timestamp).get_next()
+    except (ValueError, KeyError, TypeError, AttributeError):
+      return None
+    return datetime.utcfromtimestamp(next_timestamp)
+
+  def enqueue_start(self):
+    """Enqueues a task starting the pipeline for the current fire time.
+
+    NB: the task is named after the schedule and the fire time, so that the
+        same run is never enqueued twice.
+    """
+    fire_timestamp = calendar.timegm(self.next_run_at.timetuple())
+    shard = self.pipeline_id % self.START_SHARDS
+    try:
+      taskqueue.add(
+          queue_name='pipeline-starts',
+          target='job-service',
+          name='start_%i_%i' % (self.id, fire_timestamp),
+          url='/cron/start',
+          params={
+              'schedule_id': self.id,
+              'fire_timestamp': fire_timestamp,
+          },
+          countdown=shard * self.START_SHARD_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+
+  def claim_run(self, fire_time):
+    """Marks a fire time as run and returns False if it had already been.
+
+    NB: the check and the update are a single statement, so a redelivered
+        start task doesn't start the pipeline twice.
+    """
+    claimed = Schedule.where(id=self.id).filter(or_(
+        Schedule.last_run_at.is_(None),
+        Schedule.last_run_at < fire_time)).update(
+            {Schedule.last_run_at: fire_time}, synchronize_session=False)
+    return claimed > 0
+
 
 class GeneralSetting(BaseModel):
   __tablename__ = 'general_settings'
@@ -570,3 +794,363 @@ class Stage(BaseModel):
   def assign_attributes(self, attributes):
     for key, value in attributes.iteritems():
       self.__setattr__(key, value)
+
+
+class TaskExecution(BaseModel):
+  """Ledger entry recording the outcome of a single task execution."""
+  __tablename__ = 'task_executions'
+  __table_args__ = (
+      Index('ix_task_executions_pipeline_id_status', 'pipeline_id', 'status'),
+      Index('ix_task_executions_worker_class_status', 'worker_class',
+            'status'),
+      Index('ix_task_executions_status_updated_at', 'status', 'updated_at'),
+  )
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  task_name = Column(String(255), nullable=False, unique=True)
+  parent_task_name = Column(String(255), index=True)
+  pipeline_id = Column(Integer, ForeignKey('pipelines.id'))
+  job_id = Column(Integer, ForeignKey('jobs.id'))
+  worker_class = Column(String(255))
+  status = Column(String(50), nullable=False, default='enqueued')
+  payload = Column(Text())
+  countdown = Column(Integer, default=0)
+  # Progress markers of the worker, for a retried task to resume from.
+  checkpoint = Column(Text())
+  # Space-separated names of concurrency slots held while in flight.
+  slots = Column(String(255))
+
+  job = relationship('Job', foreign_keys=[job_id])
+
+  FINAL_STATUSES = ('succeeded', 'failed')
+  IN_FLIGHT_STATUSES = ('enqueued', 'running')
+
+  # Maximum number of buffered tasks to check when a slot gets freed up.
+  DISPATCH_BATCH_SIZE = 100
+
+  @property
+  def finished(self):
+    return self.status in self.FINAL_STATUSES
+
+  @property
+  def enqueued_tasks(self):
+    return TaskExecution.where(parent_task_name=self.task_name)
+
+  def dispatch(self, task_params, delay=0):
+    """Adds the task to the queue of its pipeline's priority lane."""
+    try:
+      task = taskqueue.add(
+          queue_name=self.job.pipeline.queue_name,
+          target='job-service',
+          name=self.task_name,
+          url='/task',
+          params=task_params,
+          countdown=delay)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      task = None
+    if self.status != 'enqueued':
+      self.update(status='enqueued', payload=None)
+    return task
+
+  def finish(self, status):
+    """Moves the entry to a final status, returns False if it already was.
+
+    NB: the check and the update are a single statement, so the outcome of
+        a task is recorded once even if several deliveries race.
+    """
+    finished = TaskExecution.where(id=self.id).filter(
+        ~TaskExecution.status.in_(self.FINAL_STATUSES)).update(
+            {TaskExecution.status: status, TaskExecution.payload: None},
+            synchronize_session=False)
+    if not finished:
+      return False
+    TaskSlot.release(self.slots)
+    set_committed_value(self, 'status', status)
+    set_committed_value(self, 'payload', None)
+    return True
+
+  @classmethod
+  def dispatch_pending(cls, pipeline_id=None, worker_class=None):
+    """Dispatches buffered tasks that fit in the freed up slots.
+
+    Buffered tasks under a cap with no free slot are skipped, so that tasks
+    buffered after them under other caps still get dispatched.
+
+    Args:
+      pipeline_id: ID of the pipeline a finished task belonged to.
+      worker_class: Worker class name of a finished task.
+    """
+    pending = cls.query.filter(cls.status == 'pending')
+    if pipeline_id is not None or worker_class is not None:
+      pending = pending.filter(or_(cls.pipeline_id == pipeline_id,
+                                   cls.worker_class == worker_class))
+    pending = pending.order_by(cls.id).limit(cls.DISPATCH_BATCH_SIZE)
+    full_slots = set()
+    for execution in pending.all():
+      limits = execution.job.get_slot_limits(execution.worker_class)
+      if full_slots.intersection(name for name, _ in limits):
+        continue
+      full_slot = execution._dispatch_buffered(limits)
+      if full_slot is not None:
+        full_slots.add(full_slot)
+
+  def _dispatch_buffered(self, limits):
+    """Dispatches a buffered task unless one of its caps has no free slot.
+
+    Returns:
+      Name of the cap with no free slot, or None.
+    """
+    with self.session.begin(subtransactions=True):
+      full_slot = TaskSlot.acquire(limits)
+      if full_slot is not None:
+        return full_slot
+      slots = TaskSlot.join(limits)
+      # The entry may have been dispatched by another task in the meantime.
+      claimed = TaskExecution.where(id=self.id, status='pending').update({
+          TaskExecution.status: 'enqueued',
+          TaskExecution.payload: None,
+          TaskExecution.slots: slots,
+      }, synchronize_session=False)
+      if not claimed:
+        TaskSlot.release(slots)
+        return None
+      task_params = json.loads(self.payload)
+      set_committed_value(self, 'status', 'enqueued')
+      set_committed_value(self, 'payload', None)
+      set_committed_value(self, 'slots', slots)
+      self.dispatch(task_params, self.countdown)
+    return None
+
+  @classmethod
+  def reap(cls, expiration_datetime):
+    """Fails in-flight tasks not heard of since a moment.
+
+    NB: a task dropped by the queue would otherwise keep its concurrency
+        slots and its job running for good.
+
+    Returns:
+      Number of tasks failed.
+    """
+    stale = cls.where(status__in=cls.IN_FLIGHT_STATUSES,
+                      updated_at__lt=expiration_datetime).all()
+    for execution in stale:
+      if execution.job is not None:
+        execution.job.worker_failed(execution)
+      else:
+        execution.finish('failed')
+    return len(stale)
+
+
+class TaskSlot(BaseModel):
+  """Number of in-flight tasks under a concurrency cap."""
+  __tablename__ = 'task_slots'
+  name = Column(String(255), primary_key=True)
+  taken = Column(Integer, nullable=False, default=0)
+
+  @staticmethod
+  def join(limits):
+    """Returns names of caps as kept in the ledger, None if there are none."""
+    return ' '.join(name for name, _ in limits) or None
+
+  @classmethod
+  def acquire(cls, limits):
+    """Takes a slot under every cap, or under none of them.
+
+    Args:
+      limits: List of (name, limit) tuples of caps.
+
+    Returns:
+      Name of the first cap with no free slot, or None if slots were taken.
+    """
+    taken = []
+    with cls.session.begin(subtransactions=True):
+      for name, limit in limits:
+        if not cls._take(name, limit):
+          cls.release(' '.join(taken))
+          return name
+        taken.append(name)
+    return None
+
+  @classmethod
+  def _take(cls, name, limit):
+    """Takes a slot under a cap, returns False if there is none left.
+
+    NB: the check and the increment are a single statement, so that tasks
+        enqueued concurrently can't overshoot the cap.
+    """
+    if cls._increment(name, limit):
+      return True
+    cls.session.execute(cls.__table__.insert().prefix_with('IGNORE'),
+                        {'name': name, 'taken': 0})
+    return cls._increment(name, limit)
+
+  @classmethod
+  def _increment(cls, name, limit):
+    taken = cls.where(name=name).filter(cls.taken < limit).update(
+        {cls.taken: cls.taken + 1}, synchronize_session=False)
+    return taken > 0
+
+  @classmethod
+  def release(cls, names):
+    """Frees up slots by space-separated names of their caps."""
+    if names:
+      cls.query.filter(cls.name.in_(names.split()), cls.taken > 0).update(
+          {cls.taken: cls.taken - 1}, synchronize_session=False)
+
+
+class ParamsBlob(BaseModel):
+  """Content-addressed storage for large serialized worker params."""
+  __tablename__ = 'params_blobs'
+  id = Column(String(40), primary_key=True)
+  value = Column(Text(length=2**24))
+
+  # Per-process cache of resolved blobs, as the same params are usually
+  # requested by many tasks of a run.
+  _cache = {}
+  _CACHE_SIZE = 100
+
+  @classmethod
+  def store(cls, value):
+    """Stores a serialized value once and returns the reference to it.
+
+    NB: a value stored again gets its updated_at refreshed, so that blobs
+        still referenced by recent tasks are kept by the cleanup.
+    """
+    digest = hashlib.sha1(value).hexdigest()
+    if not cls._touch(digest):
+      blob = cls(id=digest, value=value)
+      try:
+        blob.save()
+      except IntegrityError:
+        # Stored by a concurrent task in the meantime.
+        cls.session.expunge(blob)
+        cls._touch(digest)
+    return digest
+
+  @classmethod
+  def _touch(cls, digest):
+    touched = cls.where(id=digest).update(
+        {cls.updated_at: func.now()}, synchronize_session=False)
+    return touched > 0
+
+  @classmethod
+  def load(cls, digest):
+    """Returns a serialized value by its reference."""
+    try:
+      return cls._cache[digest]
+    except KeyError:
+      pass
+    blob = cls.find(digest)
+    if blob is None:
+      raise KeyError(digest)
+    if len(cls._cache) >= cls._CACHE_SIZE:
+      cls._cache.clear()
+    cls._cache[digest] = blob.value
+    return blob.value
+
+
+class JobLog(BaseModel):
+  """Copy of a worker log entry, indexed for the pipeline logs view."""
+  __tablename__ = 'job_logs'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  pipeline_id = Column(Integer)
+  job_id = Column(Integer)
+  worker_class = Column(String(255))
+  log_level = Column(String(50))
+  message = Column(Text)
+  timestamp = Column(DateTime, nullable=False)
+  __table_args__ = (
+      Index('ix_job_logs_pipeline_id_id', 'pipeline_id', 'id'),
+      Index('ix_job_logs_job_id_id', 'job_id', 'id'),
+      Index('ix_job_logs_pipeline_id_log_level_id',
+            'pipeline_id', 'log_level', 'id'),
+      Index('ix_job_logs_timestamp', 'timestamp'),
+      Index('ix_job_logs_message', 'message', mysql_prefix='FULLTEXT'),
+  )
+
+  @property
+  def payload(self):
+    """Returns the entry in the shape it was logged to Cloud Logging."""
+    return {
+        'labels': {
+            'pipeline_id': self.pipeline_id,
+            'job_id': self.job_id,
+            'worker_class': self.worker_class,
+        },
+        'log_level': self.log_level,
+        'message': self.message,
+    }
+
+  @classmethod
+  def add_entries(cls, entries):
+    """Inserts log entries with a single statement.
+
+    Args:
+      entries: List of (info, timestamp) tuples, where info is a structured
+          log entry as written by workers and timestamp is a UTC datetime.
+    """
+    rows = []
+    now = datetime.now()
+    for info, timestamp in entries:
+      labels = info.get('labels', {})
+      rows.append({
+          'pipeline_id': labels.get('pipeline_id'),
+          'job_id': labels.get('job_id'),
+          'worker_class': labels.get('worker_class'),
+          'log_level': info.get('log_level', 'INFO'),
+          'message': info.get('message'),
+          'timestamp': timestamp,
+          'created_at': now,
+          'updated_at': now,
+      })
+    if rows:
+      cls.session.execute(cls.__table__.insert(), rows)
+
+
+class SpooledBatch(BaseModel):
+  """Measurement Protocol batch request that failed, kept to be resent."""
+  __tablename__ = 'spooled_batches'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  pipeline_id = Column(Integer)
+  job_id = Column(Integer)
+  payload = Column(Text)
+  hits_count = Column(Integer)
+  reason = Column(String(50))
+  attempts = Column(Integer, nullable=False, default=1)
+  __table_args__ = (
+      Index('ix_spooled_batches_pipeline_id_id', 'pipeline_id', 'id'),
+      Index('ix_spooled_batches_job_id_id', 'job_id', 'id'),
+  )
+
+  @classmethod
+  def spool(cls, pipeline_id, job_id, failed_batches):
+    """Inserts failed batches with a single statement.
+
+    Args:
+      pipeline_id: ID of the pipeline of the worker that sent the batches.
+      job_id: ID of the job of the worker that sent the batches.
+      failed_batches: List of (payload, reason) tuples, where payload is the
+          body of a batch request and reason is a failure code, e.g. http_500.
+    """
+    rows = []
+    now = datetime.now()
+    for payload, reason in failed_batches:
+      rows.append({
+          'pipeline_id': pipeline_id,
+          'job_id': job_id,
+          'payload': payload,
+          'hits_count': payload.count('\n') + 1,
+          'reason': reason,
+          'attempts': 1,
+          'created_at': now,
+          'updated_at': now,
+      })
+    if rows:
+      cls.session.execute(cls.__table__.insert(), rows)
+
+  @classmethod
+  def summary(cls, pipeline_id):
+    """Returns numbers of spooled batches and hits by job and reason."""
+    return cls.session.query(
+        cls.job_id, cls.reason, func.count(cls.id), func.sum(cls.hits_count)
+    ).filter(cls.pipeline_id == pipeline_id).group_by(
+        cls.job_id, cls.reason).all()
@@ -0,0 +1,181 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measurement Protocol hits encoding and sending.
+
+Batch requests of all workers of an instance go through a shared session, so
+that connections are opened once instead of on every batch. A sender runs a
+bounded number of requests at the same time and keeps their latencies and
+status codes for reporting.
+"""
+
+import os
+import threading
+import time
+import urllib
+
+import requests
+
+from core import threadpool
+
+
+# Defines the Measurement Protocol batch endpoint, can be pointed to a local
+# stand-in for testing.
+ENDPOINT = os.environ.get('MP_ENDPOINT',
+                          'https://www.google-analytics.com/batch')
+
+# Defines how many batch requests a sender may run at the same time.
+MAX_IN_FLIGHT = int(os.environ.get('MP_MAX_IN_FLIGHT', 10))
+
+# Number of seconds to wait for a response to a batch request.
+TIMEOUT = 30
+
+# Limits of batch requests, see https://goo.gl/7VeWuB
+MAX_HITS_PER_BATCH = 20
+MAX_HIT_BYTES = 8192
+MAX_BATCH_BYTES = 16384
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+  global _session  # pylint: disable=global-statement
+  with _session_lock:
+    if _session is None:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                              pool_maxsize=MAX_IN_FLIGHT)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      _session = session
+  return _session
+
+
+class Encoder(object):
+  """Encodes rows as hit payloads, with field names quoted once per schema."""
+
+  def __init__(self, field_names, defaults=None):
+    """Initializes the encoder.
+
+    Args:
+      field_names: Names of row fields, i.e. Measurement Protocol parameters.
+      defaults: Dict of parameters added to hits unless rows have them.
+    """
+    self._prefix = urllib.urlencode(sorted(
+        (name, value) for name, value in (defaults or {}).iteritems()
+        if name not in field_names))
+    self._keys = ['%s=' % urllib.quote_plus(name) for name in field_names]
+
+  def encode(self, row):
+    """Returns a url-encoded hit payload, leaving out None values."""
+    parts = [self._prefix] if self._prefix else []
+    for key, value in zip(self._keys, row):
+      if value is None:
+        continue
+      if isinstance(value, unicode):
+        value = value.encode('utf-8')
+      parts.append(key + urllib.quote_plus(str(value)))
+    return '&'.join(parts)
+
+
+class BatchPacker(object):
+  """Packs hits in batch payloads under the hits count and bytes limits."""
+
+  def __init__(self, max_hits=MAX_HITS_PER_BATCH, max_bytes=MAX_BATCH_BYTES):
+    self.max_hits = min(max(int(max_hits), 1), MAX_HITS_PER_BATCH)
+    self.max_bytes = max_bytes
+    self._hits = []
+    self._size = 0
+
+  @property
+  def pending_count(self):
+    """Number of hits added but not returned in a batch yet."""
+    return len(self._hits)
+
+  def add(self, hit):
+    """Adds a hit no longer than MAX_HIT_BYTES.
+
+    Returns:
+      List of batch payloads filled up by the hit.
+    """
+    batches = []
+    # Hits are separated with line feeds.
+    if self._hits and self._size + 1 + len(hit) > self.max_bytes:
+      batches.append(self.flush())
+    self._size += len(hit) + 1 if self._hits else len(hit)
+    self._hits.append(hit)
+    if len(self._hits) >= self.max_hits:
+      batches.append(self.flush())
+    return batches
+
+  def flush(self):
+    """Returns the payload of pending hits, or None if there are none."""
+    if not self._hits:
+      return None
+    batch = '\n'.join(self._hits)
+    self._hits = []
+    self._size = 0
+    return batch
+
+
+class Sender(object):
+  """Sends batch requests and collects their metrics."""
+
+  def __init__(self, endpoint=None, max_in_flight=None):
+    self.endpoint = endpoint or ENDPOINT
+    self.max_in_flight = max(int(max_in_flight or MAX_IN_FLIGHT), 1)
+    self.latencies = []
+    self.status_counts = {}
+    self._lock = threading.Lock()
+
+  def post(self, payload, user_agent):
+    """Posts a batch payload and returns the response.
+
+    Raises:
+      requests.exceptions.RequestException if the request fails.
+    """
+    started_at = time.time()
+    status = 'error'
+    try:
+      response = _get_session().post(self.endpoint,
+                                     headers={'user-agent': user_agent},
+                                     data=payload,
+                                     timeout=TIMEOUT)
+      status = response.status_code
+      return response
+    finally:
+      with self._lock:
+        self.latencies.append(time.time() - started_at)
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+  def map(self, func, items):
+    """Calls a function on items with at most max_in_flight calls at a time.
+
+    Returns:
+      List of results in the order of items.
+    """
+    return threadpool.bounded_map(func, items, self.max_in_flight)
+
+  def summary(self):
+    """Returns a line describing batch latencies and status codes."""
+    if not self.latencies:
+      return 'No batches sent'
+    latencies = sorted(self.latencies)
+    statuses = ', '.join('%s: %i' % (status, count) for status, count
+                         in sorted(self.status_counts.iteritems()))
+    return ('%i batches sent in %.0f ms on median, %.0f ms at most '
+            '(statuses %s)' % (len(latencies),
+                               latencies[len(latencies) / 2] * 1000,
+                               latencies[-1] * 1000, statuses))
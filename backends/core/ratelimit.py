@@ -0,0 +1,65 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Token bucket rate limiter shared by all instances through memcache."""
+
+import time
+
+from google.appengine.api import memcache
+
+
+# Rates of named buckets as tuples of two elements: 0) number of tokens added
+# to a bucket per second, and 1) maximum number of tokens a bucket can hold.
+RATES = {
+    # Reporting API v4 allows 100 requests per 100 seconds per user.
+    'ga_reporting': (1.0, 10),
+    # Management API allows 10 queries per second per user.
+    'ga_management': (5.0, 10),
+}
+
+_NAMESPACE = 'ratelimit'
+
+# Number of attempts to update a bucket contended by other instances.
+_CAS_ATTEMPTS = 5
+
+
+def acquire(bucket, key=None, tokens=1):
+  """Takes tokens from a named bucket.
+
+  Args:
+    bucket: Name of the bucket, one of RATES keys.
+    key: Optional key to have a separate bucket per property, project, etc.
+    tokens: Number of tokens to take.
+
+  Returns:
+    0 if tokens were taken, otherwise the number of seconds to wait for the
+    bucket to refill.
+  """
+  rate, capacity = RATES[bucket]
+  name = bucket if key is None else '%s:%s' % (bucket, key)
+  client = memcache.Client()
+  for _ in xrange(_CAS_ATTEMPTS):
+    now = time.time()
+    state = client.gets(name, namespace=_NAMESPACE)
+    if state is None:
+      if client.add(name, (capacity - tokens, now), namespace=_NAMESPACE):
+        return 0
+      continue
+    level, updated_at = state
+    level = min(capacity, level + (now - updated_at) * rate)
+    if level < tokens:
+      return (tokens - level) / rate
+    if client.cas(name, (level - tokens, now), namespace=_NAMESPACE):
+      return 0
+  return tokens / rate
@@ -0,0 +1,58 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded thread pool for blocking calls made within a request."""
+
+import Queue
+import threading
+
+
+def bounded_map(func, items, max_threads):
+  """Calls a function on items with at most max_threads calls at a time.
+
+  Returns:
+    List of results in the order of items.
+
+  Raises:
+    The first exception raised by a call, once running calls are done.
+  """
+  items = list(items)
+  if max_threads <= 1 or len(items) < 2:
+    return [func(item) for item in items]
+  results = [None] * len(items)
+  errors = []
+  indexes = Queue.Queue()
+  for i in xrange(len(items)):
+    indexes.put(i)
+
+  def work():
+    while not errors:
+      try:
+        i = indexes.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = func(items[i])
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+
+  threads = [threading.Thread(target=work)
+             for _ in xrange(min(max_threads, len(items)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+  return results
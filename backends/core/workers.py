@@ -17,13 +17,16 @@
 
 from datetime import datetime
 from datetime import timedelta
-from fnmatch import fnmatch
+import fnmatch
 from functools import wraps
+import httplib
 import json
+import math
 import os
 from random import random
+import re
+import socket
 import time
-import urllib
 import uuid
 
 from apiclient.discovery import build
@@ -33,8 +36,15 @@ import cloudstorage as gcs
 from oauth2client.service_account import ServiceAccountCredentials
 from google.cloud import bigquery
 from google.cloud.exceptions import ClientError
+from google.cloud.exceptions import ServerError
+from google.cloud.exceptions import TooManyRequests
 import requests
 
+from core import circuitbreaker
+from core import mpsender
+from core import ratelimit
+from core import threadpool
+
 
 _KEY_FILE = os.path.join(os.path.dirname(__file__), '..', 'data',
                          'service-account.json')
@@ -49,10 +59,19 @@ AVAILABLE = (
     'StorageCleaner',
     'Commenter',
     'BQToMeasurementProtocol',
+    'MeasurementProtocolReplayer',
 )
 
 # Defines how many times to retry on failure, default to 5 times.
-DEFAULT_MAX_RETRIES = os.environ.get('MAX_RETRIES', 5)
+DEFAULT_MAX_RETRIES = int(os.environ.get('MAX_RETRIES', 5))
+
+# Defines how many seconds a worker may run inside a task before handing the
+# rest of its work over to a continuation task, default to 8 minutes.
+WORKER_TIME_BUDGET = int(os.environ.get('WORKER_TIME_BUDGET', 480))
+
+# Defines how many seconds to wait for BigQuery jobs inside a task before
+# handing them off to BQWaiter, default to 0, i.e. hand off right away.
+BQ_INLINE_WAIT = int(os.environ.get('BQ_INLINE_WAIT', 0))
 
 
 # pylint: disable=too-few-public-methods
@@ -62,6 +81,61 @@ class WorkerException(Exception):
   """Worker execution exceptions expected in task handler."""
 
 
+class WorkerDeferred(Exception):
+  """Raised by a worker to be re-run later instead of waiting in a task."""
+
+  def __init__(self, delay):
+    super(WorkerDeferred, self).__init__(
+        'Deferred for %.1f seconds' % delay)
+    self.delay = delay
+
+
+class RetryPolicy(object):
+  """Describes which failed calls to retry and how long to back off.
+
+  Backoff delay grows exponentially with the attempt number, with a random
+  jitter added to the exponent: base_delay * 2 ** (attempt - 1 + jitter).
+  """
+
+  def __init__(self, retryable=(socket.error, httplib.HTTPException,
+                                requests.exceptions.ConnectionError,
+                                requests.exceptions.Timeout,
+                                ServerError, TooManyRequests,
+                                gcs.TransientError),
+               retryable_statuses=(429, 500, 502, 503, 504),
+               max_attempts=DEFAULT_MAX_RETRIES + 1, base_delay=5,
+               max_delay=600, jitter=1.0, max_inline_delay=10):
+    """Initializes a policy.
+
+    Args:
+      retryable: Tuple of exception classes worth retrying.
+      retryable_statuses: HTTP statuses of HttpError worth retrying.
+      max_attempts: Maximum number of calls, including the first one.
+      base_delay: Delay before the first retry, in seconds.
+      max_delay: Maximum delay before a retry, in seconds.
+      jitter: Maximum random addition to the backoff exponent.
+      max_inline_delay: Maximum delay to sleep inside a task. A deferrable
+          worker is re-enqueued with a countdown if it has to wait longer.
+          None to always sleep, e.g. for calls made outside of _execute.
+    """
+    self.retryable = retryable
+    self.retryable_statuses = retryable_statuses
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.jitter = jitter
+    self.max_inline_delay = max_inline_delay
+
+  def is_retryable(self, exception):
+    if isinstance(exception, HttpError):
+      return exception.resp.status in self.retryable_statuses
+    return isinstance(exception, self.retryable)
+
+  def get_delay(self, attempt):
+    delay = self.base_delay * 2 ** (attempt - 1 + self.jitter * random())
+    return min(delay, self.max_delay)
+
+
 class Worker(object):
   """Abstract worker class."""
 
@@ -75,6 +149,21 @@ class Worker(object):
   # Maximum number of execution attempts.
   MAX_ATTEMPTS = 3
 
+  # Maximum number of tasks of this worker class enqueued or running at the
+  # same time across all pipelines, None means no limit.
+  MAX_CONCURRENT_TASKS = None
+
+  # Maximum number of seconds to wait for a rate limiter token inside a task.
+  # A worker is deferred if it would have to wait longer.
+  MAX_TOKEN_WAIT = 10
+
+  # Default policy for calls wrapped with retry method.
+  RETRY_POLICY = RetryPolicy()
+
+  # Whether the task handler may run the worker in-process when it's spawned
+  # with no delay by another worker.
+  RUN_INLINE = True
+
   def __init__(self, params, pipeline_id, job_id):
     self._pipeline_id = pipeline_id
     self._job_id = job_id
@@ -85,10 +174,65 @@ class Worker(object):
       except KeyError:
         self._params[p[0]] = p[3]
     self._workers_to_enqueue = []
+    # Becomes False once the worker has made changes that would be repeated
+    # by re-running it from scratch, e.g. inserted rows or sent hits.
+    self._deferrable = True
+    self._retries_count = 0
+    self._backoff_seconds = 0
+    self._log_buffer = None
+    # Progress markers of a deferred worker are carried in its params.
+    self._checkpoint = self._params.pop('_checkpoint', None) or {}
+    self._checkpoint_saver = None
+    # Failed attempts of a call that deferred the worker, so that the re-run
+    # worker gives up after as many attempts as the retry policy allows.
+    self._deferred_attempts = self._params.pop('_deferred_attempts', 0)
+    self._deadline = time.time() + WORKER_TIME_BUDGET
+
+  def _time_left(self):
+    """Returns number of seconds left until the worker's time budget is up."""
+    return self._deadline - time.time()
+
+  def _out_of_time(self):
+    return self._time_left() <= 0
+
+  def _enqueue_continuation(self):
+    """Enqueues the worker to resume from its checkpoint in another task."""
+    params = self._params.copy()
+    params['_checkpoint'] = dict(self._checkpoint)
+    self._enqueue(self.__class__.__name__, params)
+
+  def resume(self, checkpoint, saver=None):
+    """Sets the progress to resume from and the way to persist new progress.
+
+    Args:
+      checkpoint: Progress markers saved by a previous attempt, or None.
+      saver: Function taking a dict of progress markers to persist them.
+    """
+    if checkpoint:
+      self._checkpoint = checkpoint
+    self._checkpoint_saver = saver
+
+  def _save_checkpoint(self, **progress):
+    """Persists small progress markers, e.g. page tokens or row offsets.
+
+    NB: call it right after the changes the progress accounts for, as the
+        worker becomes deferrable again: a re-run worker resumes from here.
+    """
+    self._checkpoint.update(progress)
+    if self._checkpoint_saver is not None:
+      self._checkpoint_saver(self._checkpoint)
+    self._deferrable = True
+
+  @property
+  def retry_stats(self):
+    """Returns number of retried calls and total backoff time in seconds."""
+    return self._retries_count, self._backoff_seconds
 
   def _log(self, level, message, *substs):
-    from core.logging import logger
-    self.retry(logger.log_struct)({
+    if self._log_buffer is None:
+      from core.logging import LogBuffer
+      self._log_buffer = LogBuffer()
+    self._log_buffer.log_struct({
         'labels': {
             'pipeline_id': self._pipeline_id,
             'job_id': self._job_id,
@@ -107,7 +251,13 @@ class Worker(object):
   def log_error(self, message, *substs):
     self._log('ERROR', message, *substs)
 
+  def flush_logs(self):
+    """Writes buffered log entries."""
+    if self._log_buffer is not None:
+      self._log_buffer.flush()
+
   def execute(self):
+    self._deadline = time.time() + WORKER_TIME_BUDGET
     self.log_info('Started with params: %s',
                   json.dumps(self._params, sort_keys=True, indent=2,
                              separators=(', ', ': ')))
@@ -115,6 +265,21 @@ class Worker(object):
       self._execute()
     except ClientError as e:
       raise WorkerException(e)
+    except WorkerDeferred as e:
+      # Re-run the worker from scratch, as it did not finish its job.
+      self.log_info('%s', e)
+      self._backoff_seconds += e.delay
+      delay = int(math.ceil(e.delay))
+      params = self._params.copy()
+      if self._checkpoint:
+        params['_checkpoint'] = self._checkpoint
+      if self._deferred_attempts:
+        params['_deferred_attempts'] = self._deferred_attempts
+      self._workers_to_enqueue = [(self.__class__.__name__, params, delay)]
+      return self._workers_to_enqueue
+    if self._retries_count:
+      self.log_info('Retried %i calls, backed off for %.1f seconds',
+                    self._retries_count, self._backoff_seconds)
     self.log_info('Finished successfully')
     return self._workers_to_enqueue
 
@@ -125,24 +290,85 @@ class Worker(object):
   def _enqueue(self, worker_class, worker_params, delay=0):
     self._workers_to_enqueue.append((worker_class, worker_params, delay))
 
-  def retry(self, func, max_retries=DEFAULT_MAX_RETRIES):
-    """Decorator implementing retries with exponentially increasing delays."""
+  def _acquire_token(self, bucket, key=None):
+    """Takes a token from a rate limiter bucket shared by all workers.
+
+    Waits for the token if it is expected within MAX_TOKEN_WAIT seconds.
+    Otherwise defers the worker, unless it can't be re-run from scratch.
+
+    Args:
+      bucket: Name of the bucket, one of ratelimit.RATES keys.
+      key: Optional key to have a separate bucket per property, project, etc.
+    """
+    delay = ratelimit.acquire(bucket, key)
+    while delay:
+      if self._deferrable and delay > self.MAX_TOKEN_WAIT:
+        raise WorkerDeferred(delay)
+      time.sleep(delay)
+      delay = ratelimit.acquire(bucket, key)
+
+  def _check_circuit(self, service):
+    """Defers the worker while the circuit breaker of a service is open.
+
+    A worker that can't be re-run from scratch waits for the breaker to
+    half-open instead.
+
+    Args:
+      service: Name of the service, one of circuitbreaker.SERVICES keys.
+    """
+    delay = circuitbreaker.retry_after(service)
+    if delay:
+      if self._deferrable:
+        raise WorkerDeferred(delay)
+      time.sleep(delay)
+
+  def retry(self, func, max_retries=None, policy=None, service=None):
+    """Decorator implementing retries according to a retry policy.
+
+    Args:
+      func: Function to decorate.
+      max_retries: Overrides maximum number of retries of the policy.
+      policy: RetryPolicy instance, defaults to worker's RETRY_POLICY.
+      service: Name of the service called, to consult its circuit breaker
+          before each attempt and to report results of attempts to it.
+    """
+    policy = policy or self.RETRY_POLICY
+    if max_retries is None:
+      max_attempts = policy.max_attempts
+    else:
+      max_attempts = max_retries + 1
+
     @wraps(func)
     def func_with_retries(*args, **kwargs):
       """Retriable version of function being decorated."""
-      tries = 0
-      while tries < max_retries:
+      attempt = 1
+      while True:
+        if service is not None:
+          self._check_circuit(service)
         try:
-          return func(*args, **kwargs)
-        except HttpError as e:
-          # If it is a client side error, then there's no reason to retry.
-          if e.resp.status > 399 and e.resp.status < 500:
-            raise e
+          result = func(*args, **kwargs)
         except Exception as e:  # pylint: disable=broad-except
-          tries += 1
-          delay = 5 * 2 ** (tries + random())
+          retryable = policy.is_retryable(e)
+          if service is not None and retryable:
+            circuitbreaker.record_failure(service)
+          # Attempts made before the worker was deferred count as well.
+          attempt_count = attempt + self._deferred_attempts
+          if attempt_count >= max_attempts or not retryable:
+            raise
+          delay = policy.get_delay(attempt_count)
+          if (self._deferrable and policy.max_inline_delay is not None
+              and delay > policy.max_inline_delay):
+            self._deferred_attempts = attempt_count
+            raise WorkerDeferred(delay)
+          self._retries_count += 1
+          self._backoff_seconds += delay
           time.sleep(delay)
-      return func(*args, **kwargs)
+          attempt += 1
+        else:
+          self._deferred_attempts = 0
+          if service is not None:
+            circuitbreaker.record_success(service)
+          return result
     return func_with_retries
 
 
@@ -178,32 +404,86 @@ class BQWorker(Worker):
     self._job_name = '%i_%i_%s_%s' % (self._pipeline_id, self._job_id,
                                       self.__class__.__name__, uuid.uuid4())
 
+  # Bounds of the delay between checks of running BigQuery jobs, in seconds.
+  MIN_POLL_DELAY = 5
+  MAX_POLL_DELAY = 300
+
   def _begin_and_wait(self, *jobs):
     for job in jobs:
       job.begin()
+    self._wait(jobs)
+
+  def _wait(self, jobs, staged_uris=None):
+    """Waits for begun jobs inline for up to BQ_INLINE_WAIT seconds.
+
+    Jobs still running after that are handed off to BQWaiter.
+
+    Args:
+      jobs: List of begun jobs.
+      staged_uris: List of Cloud Storage URIs of files loaded by the jobs,
+          deleted once all the jobs are done.
+    """
     delay = 5
     wait_time = 0
-    all_jobs_done = False
-    while not all_jobs_done:
-      wait_time += delay
-      if wait_time > 300:  # If 5 minutes passed, then spawn BQWaiter.
-        worker_params = {
-            'job_names': [job.name for job in jobs],
-            'bq_project_id': self._params['bq_project_id']
-        }
-        self._enqueue('BQWaiter', worker_params, 60)
-        return
+    while wait_time + delay <= BQ_INLINE_WAIT:
       time.sleep(delay)
+      wait_time += delay
       if delay < 30:
         delay = [5, 10, 15, 20, 30][wait_time / 60]
-      all_jobs_done = True
-      for job in jobs:
-        job.reload()
-        if job.error_result is not None:
-          raise WorkerException(job.error_result['message'])
-        if job.state != 'DONE':
-          all_jobs_done = False
-          break
+      jobs = self._reload_running_jobs(jobs)
+      if not jobs:
+        self._delete_staged_files(staged_uris)
+        return
+    worker_params = {
+        'job_names': [job.name for job in jobs],
+        'bq_project_id': self._params['bq_project_id'],
+        'wait_started_at': time.time() - wait_time,
+    }
+    if staged_uris:
+      worker_params['staged_uris'] = staged_uris
+    self._enqueue('BQWaiter', worker_params, self.MIN_POLL_DELAY)
+
+  def _delete_staged_files(self, uris):
+    """Deletes files that have been loaded, unless deleted already."""
+    delete = self.retry(gcs.delete, service='gcs')
+    for uri in uris or []:
+      try:
+        delete(uri[len('gs:/'):])
+      except gcs.NotFoundError:
+        pass
+
+  def _reload_running_jobs(self, jobs):
+    """Reloads BigQuery jobs and returns the ones that are not done yet."""
+    running_jobs = []
+    reload_job = self.retry(lambda j: j.reload(), service='bigquery')
+    for job in jobs:
+      reload_job(job)
+      if job.error_result is not None:
+        raise WorkerException(job.error_result['message'])
+      if job.state != 'DONE':
+        running_jobs.append(job)
+      elif isinstance(job.created, datetime) and isinstance(job.ended,
+                                                            datetime):
+        self.log_info('BigQuery job %s done in %.1f seconds', job.name,
+                      (job.ended - job.created).total_seconds())
+    return running_jobs
+
+  def _get_poll_delay(self, jobs):
+    """Estimates when to check running jobs again.
+
+    Jobs that have been running for a long time are expected to keep running
+    for a while, so the delay grows with the time since the earliest job start.
+    Jobs waiting in the BigQuery queue are checked with the minimum delay.
+    """
+    running_times = []
+    for job in jobs:
+      if isinstance(job.started, datetime):
+        started = job.started.replace(tzinfo=None)
+        running_times.append((datetime.utcnow() - started).total_seconds())
+    if not running_times:
+      return self.MIN_POLL_DELAY
+    delay = int(max(running_times) / 2)
+    return min(max(delay, self.MIN_POLL_DELAY), self.MAX_POLL_DELAY)
 
 
 class BQWaiter(BQWorker):
@@ -211,20 +491,22 @@ class BQWaiter(BQWorker):
 
   def _execute(self):
     client = self._get_client()
+    jobs = []
     for job_name in self._params['job_names']:
       # pylint: disable=protected-access
-      job = bigquery.job._AsyncJob(job_name, client)
+      jobs.append(bigquery.job._AsyncJob(job_name, client))
       # pylint: enable=protected-access
-      job.reload()
-      if job.error_result is not None:
-        raise WorkerException(job.error_result['message'])
-      if job.state != 'DONE':
-        worker_params = {
-            'job_names': self._params['job_names'],
-            'bq_project_id': self._params['bq_project_id']
-        }
-        self._enqueue('BQWaiter', worker_params, 60)
-        return
+    running_jobs = self._reload_running_jobs(jobs)
+    if running_jobs:
+      worker_params = self._params.copy()
+      worker_params['job_names'] = [job.name for job in running_jobs]
+      self._enqueue('BQWaiter', worker_params,
+                    self._get_poll_delay(running_jobs))
+      return
+    self._delete_staged_files(self._params.get('staged_uris'))
+    if self._params.get('wait_started_at'):
+      self.log_info('Waited %i seconds for BigQuery jobs',
+                    time.time() - self._params['wait_started_at'])
 
 
 class BQQueryLauncher(BQWorker):
@@ -253,8 +535,14 @@ class BQQueryLauncher(BQWorker):
 class StorageWorker(Worker):
   """Abstract worker class for Cloud Storage workers."""
 
+  def _list(self, path_prefix):
+    """Returns stats of files whose paths start with a prefix."""
+    list_bucket = self.retry(
+        lambda p: [s for s in gcs.listbucket(p) if not s.is_dir],
+        service='gcs')
+    return list_bucket(path_prefix)
+
   def _get_matching_stats(self, patterned_uris):
-    stats = []
     patterns = {}
     for patterned_uri in patterned_uris:
       patterned_uri_split = patterned_uri.split('/')
@@ -265,13 +553,21 @@ class StorageWorker(Worker):
           patterns[bucket].append(pattern)
       except KeyError:
         patterns[bucket] = [pattern]
+    stats = []
     for bucket in patterns:
-      for stat in gcs.listbucket(bucket):
-        if not stat.is_dir:
-          for pattern in patterns[bucket]:
-            if fnmatch(stat.filename, pattern):
-              stats.append(stat)
-              break
+      regex = re.compile('|'.join(fnmatch.translate(p)
+                                  for p in patterns[bucket]))
+      # Only objects starting with the literal part of a pattern are listed,
+      # once for patterns sharing it.
+      path_prefixes = []
+      for path_prefix in sorted(set(
+          re.split(r'[*?[]', p, 1)[0] for p in patterns[bucket])):
+        if not any(path_prefix.startswith(p) for p in path_prefixes):
+          path_prefixes.append(path_prefix)
+      for path_prefix in path_prefixes:
+        for stat in self._list(path_prefix):
+          if regex.match(stat.filename):
+            stats.append(stat)
     return stats
 
 
@@ -286,15 +582,72 @@ class StorageCleaner(StorageWorker):
        'Days to keep files since last modification'),
   ]
 
+  # Number of files deleted at the same time.
+  MAX_CONCURRENT_DELETES = 10
+
+  # Number of files deleted by a task before the rest is handed over to a
+  # continuation.
+  MAX_DELETES_PER_TASK = 10000
+
+  def _delete(self, filename):
+    """Deletes a file, returns False if it had been deleted already."""
+    try:
+      self.retry(gcs.delete, service='gcs')(filename)
+    except gcs.NotFoundError:
+      # Deleted by another worker since it was listed.
+      return False
+    return True
+
+  def _delete_all(self, filenames):
+    """Deletes files, up to MAX_CONCURRENT_DELETES at a time.
+
+    Returns:
+      List of outcomes in the order of filenames, as tuples of two elements:
+      0) True if the file has been deleted, and 1) the exception raised or
+      None.
+    """
+    def delete(filename):
+      try:
+        return self._delete(filename), None
+      except Exception as e:  # pylint: disable=broad-except
+        return False, e
+    return threadpool.bounded_map(delete, filenames,
+                                  self.MAX_CONCURRENT_DELETES)
+
+  def _log_deleted(self, filenames):
+    """Logs numbers of deleted files per folder."""
+    counts = {}
+    for filename in filenames:
+      folder = filename.rsplit('/', 1)[0]
+      counts[folder] = counts.get(folder, 0) + 1
+    for folder in sorted(counts):
+      self.log_info('%i files deleted in gs:/%s/', counts[folder], folder)
+
   def _execute(self):
     delta = timedelta(self._params['expiration_days'])
     expiration_datetime = datetime.now() - delta
     expiration_timestamp = time.mktime(expiration_datetime.timetuple())
     stats = self._get_matching_stats(self._params['file_uris'])
-    for stat in stats:
-      if stat.st_ctime < expiration_timestamp:
-        gcs.delete(stat.filename)
-        self.log_info('gs:/%s file deleted.', stat.filename)
+    filenames = [stat.filename for stat in stats
+                 if stat.st_ctime < expiration_timestamp]
+    deleted_filenames = []
+    try:
+      for i in xrange(0, len(filenames), self.MAX_CONCURRENT_DELETES):
+        if self._out_of_time() or i >= self.MAX_DELETES_PER_TASK:
+          # Deleted files aren't listed anymore, so the continuation picks up
+          # where this worker stopped.
+          self._enqueue_continuation()
+          break
+        chunk = filenames[i:i + self.MAX_CONCURRENT_DELETES]
+        outcomes = self._delete_all(chunk)
+        # Files deleted along with a failed one are logged as well.
+        deleted_filenames.extend(
+            f for f, (deleted, _) in zip(chunk, outcomes) if deleted)
+        errors = [e for _, e in outcomes if e is not None]
+        if errors:
+          raise errors[0]
+    finally:
+      self._log_deleted(deleted_filenames)
 
 
 class StorageToBQImporter(StorageWorker, BQWorker):
@@ -384,6 +737,27 @@ class BQToStorageExporter(BQWorker):
     self._begin_and_wait(job)
 
 
+def _to_integer(value):
+  try:
+    return int(value)
+  except ValueError:
+    return None
+
+
+def _to_float(value):
+  try:
+    return float(value)
+  except ValueError:
+    return None
+
+
+def _to_date(value):
+  """Converts GA dates like 20180131 to BigQuery dates like 2018-01-31."""
+  if len(value) == 8 and value.isdigit():
+    return '%s-%s-%s' % (value[:4], value[4:6], value[6:])
+  return value
+
+
 class GAWorker(Worker):
   """Abstract class with GA-specific methods."""
 
@@ -408,8 +782,36 @@ class GAToBQImporter(BQWorker, GAWorker):
       ('bq_project_id', 'string', False, '', 'BQ Project ID'),
       ('bq_dataset_id', 'string', True, '', 'BQ Dataset ID'),
       ('bq_table_id', 'string', True, '', 'BQ Table ID'),
+      ('staging_uri', 'string', False, '',
+       ('Cloud Storage folder to stage data for a load job instead of '
+        'streaming inserts (e.g. gs://bucket/staging)')),
+      ('parallel_shards', 'number', False, 1,
+       'Number of date range parts to fetch day by day in parallel'),
   ]
 
+  # Fan-out limits: a run is split in no more than MAX_SHARDS parts, and
+  # tasks of all runs beyond MAX_CONCURRENT_TASKS wait for a free slot.
+  MAX_SHARDS = 20
+  MAX_CONCURRENT_TASKS = 40
+
+  # Converters of GA values by BigQuery field type, values of other fields are
+  # loaded as strings.
+  CONVERTERS = {
+      'INTEGER': _to_integer,
+      'FLOAT': _to_float,
+      'DATE': _to_date,
+  }
+
+  # Reporting API v4 returns up to 100,000 rows per page. Pages of wide
+  # reports are smaller to keep responses within the instance memory.
+  MIN_PAGE_SIZE = 10000
+  MAX_PAGE_SIZE = 100000
+  MAX_PAGE_VALUES = 500000
+
+  def _get_page_size(self, columns_count):
+    page_size = self.MAX_PAGE_VALUES / max(columns_count, 1)
+    return min(max(page_size, self.MIN_PAGE_SIZE), self.MAX_PAGE_SIZE)
+
   def _compose_report(self):
     dimensions = [{'name': d} for d in self._params['dimensions']]
     metrics = [{'expression': m} for m in self._params['metrics']]
@@ -423,48 +825,81 @@ class GAToBQImporter(BQWorker, GAWorker):
         'hideValueRanges': True,
         'includeEmptyRows': self._params['include_empty_rows'],
         'samplingLevel': 'LARGE',
-        'pageSize': 10000,
+        'pageSize': self._get_page_size(len(dimensions) + len(metrics)),
     }
 
-  def _get_report(self, view_id, start_date, end_date):
+  def _compile_projector(self, column_header, view_id, start_date, end_date):
+    """Maps report columns to table fields once per report.
+
+    Returns:
+      Function converting a page of report rows to a list of BQ rows.
+    """
+    dimensions = [d.replace(':', '_') for d in column_header['dimensions']]
+    metrics = [m['name'].replace(':', '_') for m in
+               column_header['metricHeader']['metricHeaderEntries']]
+    constants = {
+        'view_id': view_id,
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+    getters = []
+    for field in self._table.schema:
+      converter = self.CONVERTERS.get(field.field_type)
+      if field.name in dimensions:
+        index = dimensions.index(field.name)
+        getter = lambda rows, i=index: [r['dimensions'][i] for r in rows]
+      elif field.name in metrics:
+        index = metrics.index(field.name)
+        getter = lambda rows, i=index: [r['metrics'][0]['values'][i]
+                                        for r in rows]
+      else:
+        value = constants.get(field.name)
+        if value is not None and converter is not None:
+          value = converter(value)
+        getter = lambda rows, v=value: [v] * len(rows)
+        converter = None
+      getters.append((getter, converter))
+
+    def project(rows):
+      columns = []
+      for getter, converter in getters:
+        values = getter(rows)
+        if converter is not None:
+          values = map(converter, values)
+        columns.append(values)
+      return zip(*columns) if columns else [()] * len(rows)
+    return project
+
+  def _get_report(self, view_id, start_date, end_date, view_index=0,
+                  page_token=None):
     # TODO(dulacp): refactor this method, too complex branching logic
 
     log_str = 'View ID %s from %s till %s' % (view_id, start_date, end_date)
     self.log_info('Fetch for %s started', log_str)
     rows_fetched = 0
-    self._request['view_id'] = view_id
+    self._request['viewId'] = view_id
     self._request['dateRanges'] = [{
         'startDate': start_date,
         'endDate': end_date,
     }]
+    if page_token is not None:
+      self._request['pageToken'] = page_token
     body = {'reportRequests': [self._request]}
+    projector = None
     while True:
+      self._acquire_token('ga_reporting')
       request = self._ga_client.reports().batchGet(body=body)
-      response = self.retry(request.execute)()
+      response = self.retry(request.execute, service='ga_v4')()
       report = response['reports'][0]
-      dimensions = [d.replace(':', '_') for d in
-                    report['columnHeader']['dimensions']]
-      metrics = [m['name'].replace(':', '_') for m in
-                 report['columnHeader']['metricHeader']['metricHeaderEntries']]
-      ga_row = {
-          'view_id': view_id,
-          'start_date': start_date,
-          'end_date': end_date,
-      }
-      for row in report['data']['rows']:
-        for dimension, value in zip(dimensions, row['dimensions']):
-          ga_row[dimension] = value
-        for metric, value in zip(metrics, row['metrics'][0]['values']):
-          ga_row[metric] = value
-        bq_row = []
-        for field in self._table.schema:
-          try:
-            bq_row.append(ga_row[field.name])
-          except KeyError:
-            bq_row.append(None)
-        self._bq_rows.append(tuple(bq_row))
-      self._flush()
-      rows_fetched += len(report['data']['rows'])
+      if projector is None:
+        projector = self._compile_projector(
+            report['columnHeader'], view_id, start_date, end_date)
+      rows = report['data'].get('rows', [])
+      self._bq_rows.extend(projector(rows))
+      # Pages are inserted one by one, so that the next page token marks
+      # the progress made.
+      self._flush(forced=True)
+      rows_fetched += len(rows)
       try:
         self._request['pageToken'] = report['nextPageToken']
       except KeyError:
@@ -473,40 +908,145 @@ class GAToBQImporter(BQWorker, GAWorker):
         except KeyError:
           pass
         break
+      self._mark_progress(view_index=view_index,
+                          page_token=self._request['pageToken'])
+      if self._out_of_time():
+        del self._request['pageToken']
+        self.log_info('%i rows of data fetched for %s so far', rows_fetched,
+                      log_str)
+        return False
+    self._mark_progress(view_index=view_index + 1, page_token=None)
     self.log_info('%i rows of data fetched for %s', rows_fetched, log_str)
+    return True
+
+  def _get_reports(self, start_date, end_date):
+    """Fetches reports of all views, resuming from the last checkpoint.
+
+    Returns:
+      False if the time budget is up and a continuation has been enqueued.
+    """
+    view_index = self._checkpoint.get('view_index', 0)
+    page_token = self._checkpoint.get('page_token')
+    view_ids = self._params['view_ids']
+    for i in xrange(view_index, len(view_ids)):
+      if (self._out_of_time() or
+          not self._get_report(view_ids[i], start_date, end_date, i,
+                               page_token)):
+        self._load_staged_rows()
+        self._enqueue_continuation()
+        return False
+      page_token = None
+    self._load_staged_rows()
+    return True
+
+  def _mark_progress(self, **progress):
+    if self._staging_file is None:
+      self._save_checkpoint(**progress)
+    else:
+      # Staged rows are lost if the task fails before they're loaded, so
+      # the progress is persisted only after the load job has started.
+      self._staged_progress = progress
+
+  def _open_staging_file(self, uri):
+    return gcs.open(uri[len('gs:/'):], 'w', content_type='application/json')
+
+  def _stage(self):
+    """Starts staging rows to a run-scoped file if staging_uri is set."""
+    self._staging_file = None
+    self._staged_rows_count = 0
+    self._staged_progress = None
+    staging_uri = self._params['staging_uri'].strip().rstrip('/')
+    if staging_uri:
+      self._staging_uri = '%s/%s.json' % (staging_uri, self._job_name)
+      self._staging_file = self._open_staging_file(self._staging_uri)
+
+  def _load_staged_rows(self):
+    """Loads staged rows into the table with a single load job."""
+    if self._staging_file is None:
+      return
+    self._staging_file.close()
+    self._staging_file = None
+    if self._staged_rows_count:
+      job = self._client.load_table_from_storage(
+          self._job_name, self._table, self._staging_uri)
+      job.source_format = 'NEWLINE_DELIMITED_JSON'
+      job.write_disposition = 'WRITE_APPEND'
+      job.begin()
+      # The staged rows would be loaded again by a re-run worker.
+      self._deferrable = False
+      self.log_info('Loading %i rows staged in %s', self._staged_rows_count,
+                    self._staging_uri)
+      # The staging file is deleted once it has been loaded.
+      self._wait([job], [self._staging_uri])
+    if self._staged_progress is not None:
+      self._save_checkpoint(**self._staged_progress)
 
   def _flush(self, forced=False):
-    if self._bq_rows:
+    if self._bq_rows and self._staging_file is not None:
+      fields = [field.name for field in self._table.schema]
+      for row in self._bq_rows:
+        self._staging_file.write(json.dumps(dict(zip(fields, row))) + '\n')
+      self._staged_rows_count += len(self._bq_rows)
+      self._bq_rows = []
+    elif self._bq_rows:
       if forced or len(self._bq_rows) > 9999:
         for i in xrange(0, len(self._bq_rows), 10000):
           self._table.insert_data(self._bq_rows[i:i + 10000])
+        self._deferrable = False
         self._bq_rows = []
 
+  def _enqueue_shards(self, start_date, end_date):
+    """Splits the date range in parts fetched day by day in parallel.
+
+    Shards are workers of the same job, so the job finishes once all of them
+    have finished.
+
+    Returns:
+      False if the range is fetched by this worker without splitting.
+    """
+    days_count = (end_date - start_date).days + 1
+    shards_count = min(int(self._params['parallel_shards'] or 1),
+                       self.MAX_SHARDS, days_count)
+    if shards_count < 2:
+      return False
+    shard_days, extra_days = divmod(days_count, shards_count)
+    for i in xrange(shards_count):
+      days = shard_days + 1 if i < extra_days else shard_days
+      params = self._params.copy()
+      params['start_date'] = start_date.strftime('%Y-%m-%d')
+      params['end_date'] = (start_date + timedelta(days - 1)).strftime(
+          '%Y-%m-%d')
+      params['parallel_shards'] = 1
+      self._enqueue(self.__class__.__name__, params)
+      start_date += timedelta(days)
+    self.log_info('Date range split in %i parts', shards_count)
+    return True
+
   def _execute(self):
+    if self._params['day_by_day']:
+      start_date = datetime.strptime(
+          self._params['start_date'], '%Y-%m-%d').date()
+      end_date = datetime.strptime(
+          self._params['end_date'], '%Y-%m-%d').date()
+      if self._enqueue_shards(start_date, end_date):
+        return
     self._bq_setup()
     self._table.reload()
     self._ga_setup()
     self._compose_report()
     self._bq_rows = []
+    self._stage()
     if self._params['day_by_day']:
-      start_date = datetime.strptime(
-          self._params['start_date'], '%Y-%m-%d').date()
-      end_date = datetime.strptime(
-          self._params['end_date'], '%Y-%m-%d').date()
       date_str = start_date.strftime('%Y-%m-%d')
-      for view_id in self._params['view_ids']:
-        self._get_report(view_id, date_str, date_str)
-      self._flush(forced=True)
+      if not self._get_reports(date_str, date_str):
+        return
       if start_date != end_date:
         start_date += timedelta(1)
         params = self._params.copy()
         params['start_date'] = start_date.strftime('%Y-%m-%d')
         self._enqueue(self.__class__.__name__, params)
     else:
-      for view_id in self._params['view_ids']:
-        self._get_report(
-            view_id, self._params['start_date'], self._params['end_date'])
-      self._flush(forced=True)
+      self._get_reports(self._params['start_date'], self._params['end_date'])
 
 
 class GADataImporter(GAWorker):
@@ -528,6 +1068,7 @@ class GADataImporter(GAWorker):
   _BUFFER_SIZE = 256 * 1024
 
   def _upload(self):
+    self._acquire_token('ga_management', self._params['property_id'])
     with gcs.open(self._file_name, read_buffer_size=self._BUFFER_SIZE) as f:
       media = MediaIoBaseUpload(f, mimetype='application/octet-stream',
                                 chunksize=self._BUFFER_SIZE, resumable=True)
@@ -560,23 +1101,25 @@ class GADataImporter(GAWorker):
       self.log_info('Upload Complete.')
 
   def _delete_older(self, uploads_to_keep):
+    self._acquire_token('ga_management', self._params['property_id'])
     request = self._ga_client.management().uploads().list(
         accountId=self._account_id, webPropertyId=self._params['property_id'],
         customDataSourceId=self._params['dataset_id'])
-    response = self.retry(request.execute)()
+    response = self.retry(request.execute, service='ga_v3')()
     uploads = sorted(response.get('items', []), key=lambda u: u['uploadTime'])
     if uploads_to_keep:
       ids_to_delete = [u['id'] for u in uploads[:-uploads_to_keep]]
     else:
       ids_to_delete = [u['id'] for u in uploads]
     if ids_to_delete:
+      self._acquire_token('ga_management', self._params['property_id'])
       request = self._ga_client.management().uploads().deleteUploadData(
           accountId=self._account_id,
           webPropertyId=self._params['property_id'],
           customDataSourceId=self._params['dataset_id'],
           body={
               'customDataImportUids': ids_to_delete})
-      self.retry(request.execute)()
+      self.retry(request.execute, service='ga_v3')()
       self.log_info('%i older upload(s) deleted.', len(ids_to_delete))
 
   def _execute(self):
@@ -586,6 +1129,8 @@ class GADataImporter(GAWorker):
     if self._params['max_uploads'] > 0 and self._params['delete_before']:
       self._delete_older(self._params['max_uploads'] - 1)
     self._upload()
+    # The data would be uploaded to GA again by a re-run worker.
+    self._deferrable = False
     if self._params['max_uploads'] > 0 and not self._params['delete_before']:
       self._delete_older(self._params['max_uploads'])
 
@@ -619,12 +1164,13 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
     max_results = 100
     total_results = 100
     while start_index <= total_results:
+      self._acquire_token('ga_management', self._params['property_id'])
       request = self._ga_client.management().remarketingAudience().list(
           accountId=self._account_id,
           webPropertyId=self._params['property_id'],
           start_index=start_index,
           max_results=max_results)
-      response = self.retry(request.execute)()
+      response = self.retry(request.execute, service='ga_v3')()
       total_results = response['totalResults']
       start_index += max_results
       audiences += response['items']
@@ -682,20 +1228,23 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
 
   def _update_ga_audiences(self):
     """Updates and/or creates audiences in GA."""
+    # NB: deferred worker re-computes the diff, so it is safe to defer.
     for audience in self._audiences_to_insert:
+      self._acquire_token('ga_management', self._params['property_id'])
       request = self._ga_client.management().remarketingAudience().insert(
           accountId=self._account_id,
           webPropertyId=self._params['property_id'],
           body=audience)
-      self.retry(request.execute)()
+      self.retry(request.execute, service='ga_v3')()
     for audience_id in self._audiences_to_patch:
       audience = self._audiences_to_patch[audience_id]
+      self._acquire_token('ga_management', self._params['property_id'])
       request = self._ga_client.management().remarketingAudience().patch(
           accountId=self._account_id,
           webPropertyId=self._params['property_id'],
           remarketingAudienceId=audience_id,
           body=audience)
-      self.retry(request.execute)()
+      self.retry(request.execute, service='ga_v3')()
 
   def _execute(self):
     self._account_id = self._params['property_id'].split('-')[1]
@@ -729,7 +1278,7 @@ class MLWaiter(MLWorker):
     self._get_ml_client()
     request = self._ml_client.projects().jobs().get(
         name=self._params['job_name'])
-    job = self.retry(request.execute)()
+    job = self.retry(request.execute, service='ml')()
     if job.get('state') not in self.FINAL_STATUSES:
       self._enqueue('MLWaiter', {'job_name': self._params['job_name']}, 60)
 
@@ -765,38 +1314,55 @@ class MLPredictor(MLWorker):
     self._get_ml_client()
     request = self._ml_client.projects().jobs().create(parent=project_id,
                                                        body=body)
-    self.retry(request.execute)()
+    self.retry(request.execute, service='ml')()
     job_name = '%s/jobs/%s' % (project_id, self._ml_job_id)
     self._enqueue('MLWaiter', {'job_name': job_name}, 60)
 
 
 class MeasurementProtocolException(WorkerException):
   """Measurement Protocol execution exception."""
-  pass
+
+  def __init__(self, message, status_code=None):
+    super(MeasurementProtocolException, self).__init__(message)
+    self.status_code = status_code
 
 
 class MeasurementProtocolWorker(Worker):
   """Abstract Measurement Protocol worker."""
 
-  def _get_payload_from_data(self, data):
-    payload = {'v': 1}  # Use version 1
-    payload.update(data)
-    return payload
+  # Policy for batch requests, a failed batch is retried once.
+  MP_RETRY_POLICY = RetryPolicy(
+      retryable=(MeasurementProtocolException,
+                 requests.exceptions.ConnectionError,
+                 requests.exceptions.Timeout),
+      max_attempts=2)
 
-  def _prepare_payloads_for_batch_request(self, payloads):
-    """Merges payloads to send them in a batch request.
+  # Maximum number of batch requests of a worker running at the same time.
+  MP_MAX_IN_FLIGHT = mpsender.MAX_IN_FLIGHT
 
-    Arguments:
-      payloads list of payload, each payload being a dictionary.
+  def _get_mp_sender(self):
+    try:
+      return self._mp_sender
+    except AttributeError:
+      self._mp_sender = mpsender.Sender(max_in_flight=self.MP_MAX_IN_FLIGHT)
+      return self._mp_sender
 
-    Returns: concatenated url-encoded payloads.
-        For example:
+  def _send_batch(self, batch_payload):
+    """Sends a batch request with retries.
 
-          param1=value10&param2=value20
-          param1=value11&param2=value21
+    Returns:
+      None if the batch has been sent, otherwise the reason of the failure.
     """
-    assert isinstance(payloads, list) or isinstance(payloads, tuple)
-    return '\n'.join(map(lambda p: urllib.urlencode(p), payloads))
+    try:
+      self.retry(self._send_batch_hits,
+                 policy=self.MP_RETRY_POLICY)(batch_payload)
+    except MeasurementProtocolException as e:
+      return 'http_%s' % e.status_code
+    except requests.exceptions.Timeout:
+      return 'timeout'
+    except requests.exceptions.ConnectionError:
+      return 'connection_error'
+    return None
 
   def _send_batch_hits(self, batch_payload, user_agent='CRMint / 0.1'):
     """Sends a batch request to the Measurement Protocol endpoint.
@@ -813,15 +1379,21 @@ class MeasurementProtocolWorker(Worker):
 
     Raises: MeasurementProtocolException if the HTTP request fails.
     """
-    headers = {'user-agent': user_agent}
-    req = requests.post('https://www.google-analytics.com/batch',
-                        headers=headers,
-                        data=batch_payload)
+    self._check_circuit('mp')
+    try:
+      req = self._get_mp_sender().post(batch_payload, user_agent)
+    except requests.exceptions.RequestException:
+      circuitbreaker.record_failure('mp')
+      raise
 
-    if req.status_code != requests.codes.ok:
+    if req.status_code == requests.codes.ok:
+      circuitbreaker.record_success('mp')
+    else:
+      circuitbreaker.record_failure('mp')
       raise MeasurementProtocolException('Failed to send event hit with status'
                                          'code (%s) and parameters: %s'
-                                         % (req.status_code, batch_payload))
+                                         % (req.status_code, batch_payload),
+                                         req.status_code)
 
 
 class BQToMeasurementProtocol(BQWorker):
@@ -834,38 +1406,40 @@ class BQToMeasurementProtocol(BQWorker):
       ('mp_batch_size', 'number', True, 20, 'Measurement Protocol batch size (https://goo.gl/7VeWuB)'),
   ]
 
-  # BigQuery batch size for querying results. Default to 10,000.
+  # Number of table rows sent by a processor. Default to 10,000.
   BQ_BATCH_SIZE = int(1e4)
 
-  # Maximum number of jobs to enqueued before spawning a new scheduler.
-  MAX_ENQUEUED_JOBS = 50
+  # Maximum number of processors enqueued by a task before spawning a new
+  # scheduler. Processors are only enqueued after the worker has returned, so
+  # their cost doesn't show in the time budget.
+  MAX_RANGES_PER_TASK = 50
 
   def _execute(self):
     self._bq_setup()
     self._table.reload()
-    page_token = self._params.get('bq_page_token', None)
-    batch_size = self.BQ_BATCH_SIZE
-    query_iterator = self.retry(self._table.fetch_data, max_retries=1)(
-        max_results=batch_size,
-        page_token=page_token)
-
-    enqueued_jobs_count = 0
-    for query_page in query_iterator.pages:
-      # Enqueue job for this page
+    # Ranges of rows are read by processors in parallel, so that the table is
+    # read once and no page token has to be fetched to schedule a page.
+    # NB: the row count of the metadata leaves out rows in the streaming
+    #     buffer, which are read by the processor of the last range.
+    rows_count = self._params.get('bq_rows_count') or self._table.num_rows or 0
+    start_index = self._params.get('bq_start_index') or 0
+    ranges_count = 0
+    while True:
       worker_params = self._params.copy()
-      worker_params['bq_page_token'] = page_token
+      worker_params['bq_start_index'] = start_index
       worker_params['bq_batch_size'] = self.BQ_BATCH_SIZE
+      worker_params['bq_rows_count'] = rows_count
       self._enqueue('BQToMeasurementProtocolProcessor', worker_params, 0)
-      enqueued_jobs_count += 1
-
-      # Updates the page token reference for the next iteration.
-      page_token = query_iterator.next_page_token
+      start_index += self.BQ_BATCH_SIZE
+      ranges_count += 1
+      if start_index >= rows_count:
+        return
 
-      # Spawns a new job to schedule the remaining pages.
-      if (enqueued_jobs_count >= self.MAX_ENQUEUED_JOBS
-          and page_token is not None):
+      # Spawns a new job to schedule the remaining ranges.
+      if ranges_count >= self.MAX_RANGES_PER_TASK:
         worker_params = self._params.copy()
-        worker_params['bq_page_token'] = page_token
+        worker_params['bq_start_index'] = start_index
+        worker_params['bq_rows_count'] = rows_count
         self._enqueue(self.__class__.__name__, worker_params, 0)
         return
 
@@ -873,36 +1447,181 @@ class BQToMeasurementProtocol(BQWorker):
 class BQToMeasurementProtocolProcessor(BQWorker, MeasurementProtocolWorker):
   """Worker pushing to Measurement Protocol the first page only of a query"""
 
-  def _send_payload_list(self, payload_list):
-    batch_payload = self._prepare_payloads_for_batch_request(payload_list)
-    try:
-      self.retry(self._send_batch_hits, max_retries=1)(batch_payload)
-    except MeasurementProtocolException as e:
-      escaped_message = e.message.replace('%', '%%')
-      self.log_error(escaped_message)
+  # Keeps large backfills from taking over all the job-service instances.
+  MAX_CONCURRENT_TASKS = 50
+
+  # Number of batches to send between checkpoints. Hits of up to that many
+  # batches are sent again when a failed task is retried.
+  CHECKPOINT_BATCHES = 10
+
+  def _send_batches(self, batch_payloads):
+    """Sends batch requests, up to MP_MAX_IN_FLIGHT at a time.
+
+    Batches that still fail after retries are spooled to be resent later.
+    """
+    # Hits of batches in flight would be sent again by a re-run worker.
+    self._deferrable = False
+    reasons = self._get_mp_sender().map(self._send_batch, batch_payloads)
+    failed_batches = [(payload, reason) for payload, reason
+                      in zip(batch_payloads, reasons) if reason is not None]
+    if failed_batches:
+      self._spool(failed_batches)
+      self.log_error('%i batches failed and were spooled to be resent: %s',
+                     len(failed_batches),
+                     ', '.join(sorted(set(r for _, r in failed_batches))))
+
+  def _spool(self, failed_batches):
+    from core.models import SpooledBatch
+    SpooledBatch.spool(self._pipeline_id, self._job_id, failed_batches)
+
+  def _reject_hits(self, hits_count, sample_hit):
+    self.log_warn('%i hits rejected as longer than %i bytes, e.g. %s...',
+                  hits_count, mpsender.MAX_HIT_BYTES, sample_hit[:200])
 
   def _process_query_results(self, query_data, query_schema):
-    """Sends event hits from query data."""
-    fields = [f.name for f in query_schema]
-    payload_list = []
+    """Sends event hits from query data, resuming from the last checkpoint.
+
+    Returns:
+      False if the time budget is up and a continuation sends the rest.
+    """
+    encoder = mpsender.Encoder([f.name for f in query_schema], {'v': 1})
+    packer = mpsender.BatchPacker(max_hits=self._params['mp_batch_size'])
+    rows_sent = self._checkpoint.get('rows_sent', 0)
+    rows_processed = 0
+    batches_sent = 0
+    batches = []
+    rejected_count = 0
+    rejected_sample = None
     for row in query_data:
-      data = dict(zip(fields, row))
-      payload = self._get_payload_from_data(data)
-      payload_list.append(payload)
-      if len(payload_list) >= self._params['mp_batch_size']:
-        self._send_payload_list(payload_list)
-        payload_list = []
-    if payload_list:
-      # Sends remaining payloads.
-      self._send_payload_list(payload_list)
+      rows_processed += 1
+      if rows_processed <= rows_sent:
+        continue
+      hit = encoder.encode(row)
+      if len(hit) > mpsender.MAX_HIT_BYTES:
+        rejected_count += 1
+        rejected_sample = rejected_sample or hit
+        continue
+      batches.extend(packer.add(hit))
+      if len(batches) >= self.MP_MAX_IN_FLIGHT:
+        self._send_batches(batches)
+        batches_sent += len(batches)
+        batches = []
+        # Hits waiting in the packer are sent again by a continuation.
+        progress = rows_processed - packer.pending_count
+        if self._out_of_time():
+          self._save_checkpoint(rows_sent=progress)
+          self._enqueue_continuation()
+          return False
+        if batches_sent >= self.CHECKPOINT_BATCHES:
+          self._save_checkpoint(rows_sent=progress)
+          batches_sent = 0
+    else:
+      # Sends remaining hits.
+      batches.append(packer.flush())
+      batches = [batch for batch in batches if batch is not None]
+      if batches:
+        self._send_batches(batches)
+    if rejected_count:
+      self._reject_hits(rejected_count, rejected_sample)
+    return True
+
+  def _fetch_page(self, start_index, max_results):
+    """Reads a page of table rows from a start index.
+
+    Returns:
+      List of rows and whether the table has rows past the page.
+    """
+    rows_iterator = self._table.fetch_data(max_results=max_results)
+    # The client has no start index argument, it's passed as an extra query
+    # parameter of the tabledata.list request.
+    rows_iterator.extra_params['startIndex'] = start_index
+    page = next(rows_iterator.pages)
+    return list(page), rows_iterator.next_page_token is not None
+
+  def _fetch_rows(self, start_index, max_results):
+    """Reads a range of table rows.
+
+    Returns:
+      List of rows and whether the table has rows past the range.
+    """
+    rows = []
+    fetch_page = self.retry(self._fetch_page, max_retries=1,
+                            service='bigquery')
+    has_more = True
+    while has_more and len(rows) < max_results:
+      page_rows, has_more = fetch_page(start_index + len(rows),
+                                       max_results - len(rows))
+      # Pages are cut short by the response size limit, but for the last one.
+      rows.extend(page_rows)
+      if not page_rows:
+        break
+    return rows, has_more
 
   def _execute(self):
     self._bq_setup()
     self._table.reload()
-    page_token = self._params['bq_page_token'] or None
+    start_index = self._params['bq_start_index']
     batch_size = self._params['bq_batch_size']
-    query_iterator = self.retry(self._table.fetch_data, max_retries=1)(
-        max_results=batch_size,
-        page_token=page_token)
-    query_first_page = next(query_iterator.pages)
-    self._process_query_results(query_first_page, query_iterator.schema)
+    rows, has_more = self._fetch_rows(start_index, batch_size)
+    finished = self._process_query_results(rows, self._table.schema)
+    self.log_info(self._get_mp_sender().summary())
+    # Rows streamed in after the ranges were scheduled are read by processors
+    # spawned one after the other from the last range.
+    end_index = start_index + batch_size
+    rows_count = self._params.get('bq_rows_count')
+    if (finished and has_more and rows_count is not None and
+        end_index >= rows_count):
+      worker_params = self._params.copy()
+      worker_params['bq_start_index'] = end_index
+      worker_params['bq_rows_count'] = end_index + batch_size
+      self._enqueue(self.__class__.__name__, worker_params, 0)
+
+
+class MeasurementProtocolReplayer(MeasurementProtocolWorker):
+  """Worker resending Measurement Protocol batches spooled by other jobs."""
+
+  PARAMS = [
+      ('job_ids', 'string_list', False, '',
+       'Job IDs to resend failed hits of (all pipeline jobs if empty)'),
+  ]
+
+  # Number of spooled batches loaded from the database at a time.
+  REPLAY_BATCH_SIZE = 100
+
+  def _execute(self):
+    from core.models import SpooledBatch
+    filters = {
+        'pipeline_id': self._pipeline_id,
+        'id__gt': self._checkpoint.get('last_id', 0),
+    }
+    job_ids = [int(i) for i in self._params['job_ids'] if str(i).strip()]
+    if job_ids:
+      filters['job_id__in'] = job_ids
+    hits_sent = 0
+    batches_failed = 0
+    while True:
+      spooled_batches = SpooledBatch.where(**filters).order_by(
+          SpooledBatch.id).limit(self.REPLAY_BATCH_SIZE).all()
+      if not spooled_batches:
+        break
+      self._deferrable = False
+      reasons = self._get_mp_sender().map(
+          self._send_batch, [b.payload for b in spooled_batches])
+      sent_ids = []
+      for spooled_batch, reason in zip(spooled_batches, reasons):
+        if reason is None:
+          sent_ids.append(spooled_batch.id)
+          hits_sent += spooled_batch.hits_count
+        else:
+          spooled_batch.update(reason=reason,
+                               attempts=spooled_batch.attempts + 1)
+          batches_failed += 1
+      if sent_ids:
+        SpooledBatch.where(id__in=sent_ids).delete(synchronize_session=False)
+      filters['id__gt'] = spooled_batches[-1].id
+      self._save_checkpoint(last_id=spooled_batches[-1].id)
+      if self._out_of_time():
+        self._enqueue_continuation()
+        break
+    self.log_info('%i spooled hits resent, %i batches failed again',
+                  hits_sent, batches_failed)
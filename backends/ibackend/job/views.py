@@ -50,6 +50,8 @@ job_fields = {
     'start_conditions': fields.List(fields.Nested(start_condition_fields)),
     'pipeline_id': fields.Integer,
     'params': fields.List(fields.Nested(param_fields)),
+    'retries_count': fields.Integer,
+    'backoff_seconds': fields.Float,
     'message': fields.String
 }
 
@@ -13,14 +13,12 @@
 # limitations under the License.
 
 """Pipeline section."""
+import hashlib
 import time
 import datetime
 import uuid
 
-from google.appengine.api import app_identity
-from google.appengine.api import urlfetch
-from google.cloud.logging import DESCENDING
-
+from google.appengine.api import memcache
 import werkzeug
 from flask import Blueprint, json
 from flask_restful import abort
@@ -29,9 +27,10 @@ from flask_restful import marshal_with
 from flask_restful import Resource
 from flask_restful import reqparse
 
-from core.logging import logger_name
 from core.models import Job
+from core.models import JobLog
 from core.models import Pipeline
+from core.models import SpooledBatch
 
 from ibackend.extensions import api
 
@@ -41,6 +40,8 @@ parser = reqparse.RequestParser()
 parser.add_argument('name')
 parser.add_argument('emails_for_notifications')
 parser.add_argument('run_on_schedule')
+parser.add_argument('priority', choices=('high', 'normal', 'low'))
+parser.add_argument('max_concurrent_tasks', type=int)
 parser.add_argument('schedules', type=list, location='json')
 parser.add_argument('params', type=list, location='json')
 
@@ -63,6 +64,8 @@ pipeline_fields = {
     'status': fields.String(attribute='state'),
     'updated_at': fields.String,
     'run_on_schedule': fields.Boolean,
+    'priority': fields.String,
+    'max_concurrent_tasks': fields.Integer,
     'schedules': fields.List(fields.Nested(schedule_fields)),
     'params': fields.List(fields.Nested(param_fields)),
     'message': fields.String,
@@ -176,6 +179,8 @@ class PipelineExport(Resource):
 
     data = {
         'name': pipeline.name,
+        'priority': pipeline.priority,
+        'max_concurrent_tasks': pipeline.max_concurrent_tasks,
         'jobs': jobs,
         'params': pipeline_params,
         'schedules': pipeline_schedules
@@ -262,14 +267,21 @@ class PipelineRunOnSchedule(Resource):
     return pipeline
 
 
+def _iso_datetime(value):
+  """Parses a UTC datetime formatted by JavaScript Date.toISOString."""
+  return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+_LOGS_NAMESPACE = 'pipeline_logs'
+
 log_parser = reqparse.RequestParser()
-log_parser.add_argument('next_page_token')
+log_parser.add_argument('next_page_token', type=int)
 log_parser.add_argument('worker_class')
 log_parser.add_argument('job_id')
 log_parser.add_argument('log_level')
 log_parser.add_argument('query')
-log_parser.add_argument('fromdate')
-log_parser.add_argument('todate')
+log_parser.add_argument('fromdate', type=_iso_datetime)
+log_parser.add_argument('todate', type=_iso_datetime)
 
 log_fields = {
     'timestamp': fields.String,
@@ -285,64 +297,121 @@ logs_fields = {
 
 class PipelineLogs(Resource):
 
-  def get(self, pipeline_id):
-    args = log_parser.parse_args()
+  PAGE_SIZE = 20
+
+  # Number of seconds to keep prefetched pages in memcache.
+  PREFETCH_TTL = 300
+
+  def _cache_key(self, pipeline_id, args):
+    digest = hashlib.sha1(repr(sorted(args.items()))).hexdigest()
+    return '%s:%s' % (pipeline_id, digest)
+
+  def _page(self, logs, job_names, next_page_token):
     entries = []
-    urlfetch.set_default_fetch_deadline(300)
+    for log in logs:
+      if log.job_id in job_names:
+        entries.append({
+            'timestamp': '%s+00:00' % log.timestamp,
+            'payload': log.payload,
+            'job_name': job_names[log.job_id],
+            'log_level': log.log_level,
+        })
+    return {
+        'entries': entries,
+        'next_page_token': next_page_token
+    }
+
+  def get(self, pipeline_id):
+    """Returns a page of pipeline logs, newest first.
 
-    next_page_token = args.get('next_page_token')
-    page_size = 20
-    from core.logging import client
+    NB: pages are keyed by entry id, the token of the next page being the id
+        of the last entry on the current page. Entries of the next page are
+        fetched along with the current ones and cached, as the log view is
+        usually scrolled further.
+    """
+    args = log_parser.parse_args()
+    if args.get('next_page_token'):
+      page = memcache.get(self._cache_key(pipeline_id, args),
+                          namespace=_LOGS_NAMESPACE)
+      if page is not None:
+        return page
 
-    project_id = app_identity.get_application_id()
-    filter_ = 'logName="projects/%s/logs/%s"' % (project_id, logger_name)
-    filter_ += ' AND jsonPayload.labels.pipeline_id="%s"' % pipeline_id
+    filters = {'pipeline_id': pipeline_id}
     if args.get('worker_class'):
-      filter_ += ' AND jsonPayload.labels.worker_class="%s"' \
-          % args.get('worker_class')
+      filters['worker_class'] = args.get('worker_class')
     if args.get('job_id'):
-      filter_ += ' AND jsonPayload.labels.job_id="%s"' % args.get('job_id')
+      filters['job_id'] = args.get('job_id')
     if args.get('log_level'):
-      filter_ += ' AND jsonPayload.log_level="%s"' % args.get('log_level')
-    if args.get('query'):
-      filter_ += ' AND jsonPayload.message:"%s"' % args.get('query')
+      filters['log_level'] = args.get('log_level')
     if args.get('fromdate'):
-      filter_ += ' AND timestamp>="%s"' % args.get('fromdate')
+      filters['timestamp__ge'] = args.get('fromdate')
     if args.get('todate'):
-      filter_ += ' AND timestamp<="%s"' % args.get('todate')
-    iterator = client.list_entries(
-        projects=[project_id],
-        filter_=filter_,
-        order_by=DESCENDING,
-        page_size=page_size,
-        page_token=next_page_token
-    )
-    page = next(iterator.pages)
-
-    for entry in page:
-      # print '    Page number: %d' % (iterator.page_number,)
-      # print '  Items in page: %d' % (page.num_items,)
-      # print 'Items remaining: %d' % (page.remaining,)
-      # print 'Next page token: %s' % (iterator.next_page_token,)
-      # print '----------------------------'
-      if isinstance(entry.payload, dict) \
-         and entry.payload.get('labels') \
-         and entry.payload.get('labels').get('job_id'):
-
-        job = Job.find(entry.payload.get('labels').get('job_id'))
-        if job:
-          log = {
-              'timestamp': entry.timestamp.__str__(),
-              'payload': entry.payload,
-              'job_name': job.name,
-              'log_level': entry.payload.get('log_level', 'INFO')
-          }
-          entries.append(log)
-      next_page_token = iterator.next_page_token
-    return {
-        'entries': entries,
-        'next_page_token': next_page_token
-    }
+      filters['timestamp__le'] = args.get('todate')
+    if args.get('next_page_token'):
+      filters['id__lt'] = args.get('next_page_token')
+    query = JobLog.where(**filters)
+    if args.get('query'):
+      query = query.filter(JobLog.message.match(args.get('query')))
+    logs = query.order_by(JobLog.id.desc()).limit(2 * self.PAGE_SIZE).all()
+
+    job_ids = set([log.job_id for log in logs])
+    job_names = {}
+    if job_ids:
+      job_names = dict(Job.session.query(Job.id, Job.name).filter(
+          Job.id.in_(job_ids)).all())
+
+    pages = [logs[:self.PAGE_SIZE], logs[self.PAGE_SIZE:]]
+    next_page_token = None
+    if len(pages[0]) == self.PAGE_SIZE:
+      next_page_token = pages[0][-1].id
+    if pages[1]:
+      following_page_token = None
+      if len(pages[1]) == self.PAGE_SIZE:
+        following_page_token = str(pages[1][-1].id)
+      next_args = dict(args, next_page_token=int(next_page_token))
+      memcache.set(self._cache_key(pipeline_id, next_args),
+                   self._page(pages[1], job_names, following_page_token),
+                   time=self.PREFETCH_TTL, namespace=_LOGS_NAMESPACE)
+    if next_page_token is not None:
+      next_page_token = str(next_page_token)
+    return self._page(pages[0], job_names, next_page_token)
+
+
+spool_entry_fields = {
+    'job_id': fields.Integer,
+    'job_name': fields.String,
+    'reason': fields.String,
+    'batches_count': fields.Integer,
+    'hits_count': fields.Integer,
+}
+
+spool_fields = {
+    'entries': fields.List(fields.Nested(spool_entry_fields)),
+}
+
+
+class PipelineSpool(Resource):
+
+  @marshal_with(spool_fields)
+  def get(self, pipeline_id):
+    """Returns numbers of failed Measurement Protocol batches and hits to be
+    resent, by job and failure reason."""
+    summary = SpooledBatch.summary(pipeline_id)
+    job_ids = set([job_id for job_id, _, _, _ in summary])
+    job_names = {}
+    if job_ids:
+      job_names = dict(Job.session.query(Job.id, Job.name).filter(
+          Job.id.in_(job_ids)).all())
+    entries = []
+    for job_id, reason, batches_count, hits_count in summary:
+      entries.append({
+          'job_id': job_id,
+          'job_name': job_names.get(job_id),
+          'reason': reason,
+          'batches_count': batches_count,
+          'hits_count': hits_count,
+      })
+    return {'entries': entries}
 
 
 api.add_resource(PipelineList, '/pipelines')
@@ -356,3 +425,4 @@ api.add_resource(
     '/pipelines/<pipeline_id>/run_on_schedule'
 )
 api.add_resource(PipelineLogs, '/pipelines/<pipeline_id>/logs')
+api.add_resource(PipelineSpool, '/pipelines/<pipeline_id>/spool')
@@ -13,13 +13,19 @@
 # limitations under the License.
 
 """Cron handler."""
+from datetime import datetime
+from datetime import timedelta
 from flask import Blueprint
 from flask_restful import Resource
+from flask_restful import reqparse
 from jbackend.extensions import api
 import logging
-import time
+import os
+from core.models import JobLog
+from core.models import ParamsBlob
 from core.models import Pipeline
-from croniter import croniter
+from core.models import Schedule
+from core.models import TaskExecution
 
 
 blueprint = Blueprint('cron', __name__)
@@ -28,24 +34,95 @@ blueprint = Blueprint('cron', __name__)
 class Cron(Resource):
   """Resource to handle GET requests from cron service."""
 
-  def _its_time(self, cron_format):
-    """Returns True if current time matches cron time spec."""
-    now = int(time.time())
-    itr = croniter(cron_format, now - 60)
-    nxt = itr.get_next()
-    return now / 60 * 60 == nxt
+  def get(self):
+    """Fans out starts of pipelines with schedules due to fire.
+
+    NB: a schedule missed because of a delayed cron invocation is still due,
+        so the pipeline is started by the next invocation. Several missed
+        fire times of a schedule result in a single start.
+    """
+    now = datetime.utcnow()
+    for schedule in Schedule.where(next_run_at__isnull=True,
+                                   is_valid=True).all():
+      schedule.advance(now)
+    due_schedules = Schedule.query.join(Schedule.pipeline).filter(
+        Pipeline.run_on_schedule.is_(True), Schedule.next_run_at <= now)
+    pipeline_ids = set()
+    for schedule in due_schedules.all():
+      if schedule.pipeline_id not in pipeline_ids:
+        schedule.enqueue_start()
+        pipeline_ids.add(schedule.pipeline_id)
+      schedule.advance(now)
+    return 'OK', 200
+
+
+start_parser = reqparse.RequestParser()
+start_parser.add_argument('schedule_id', type=int, required=True)
+start_parser.add_argument('fire_timestamp', type=int, required=True)
+
+
+class ScheduledStart(Resource):
+  """Resource to start a pipeline for a fire time of its schedule."""
+
+  def post(self):
+    args = start_parser.parse_args()
+    schedule = Schedule.find(args['schedule_id'])
+    if schedule is None or schedule.pipeline is None:
+      return 'OK', 200
+    pipeline = schedule.pipeline
+    if not pipeline.run_on_schedule:
+      return 'OK', 200
+    fire_time = datetime.utcfromtimestamp(args['fire_timestamp'])
+    if schedule.claim_run(fire_time):
+      logging.info('Trying to start pipeline %s', pipeline.name)
+      pipeline.start()
+    return 'OK', 200
+
+
+class Reaper(Resource):
+  """Resource to fail tasks lost by the queue and dispatch buffered ones."""
+
+  # Number of hours after which an in-flight task not heard of is lost. Way
+  # longer than a worker may run and be retried for.
+  STALE_HOURS = 6
+
+  def get(self):
+    expiration_datetime = datetime.now() - timedelta(hours=self.STALE_HOURS)
+    reaped_count = TaskExecution.reap(expiration_datetime)
+    if reaped_count:
+      logging.warning('Failed %i tasks lost by the queue', reaped_count)
+    TaskExecution.dispatch_pending()
+    return 'OK', 200
+
+
+class Cleanup(Resource):
+  """Resource to purge outdated task bookkeeping records and logs."""
+
+  # Number of days to keep task ledger entries and stored worker params.
+  RETENTION_DAYS = 30
+
+  # Number of days to keep job logs in the local store.
+  LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', 30))
 
   def get(self):
-    """Finds and enqueues pipelines scheduled to be executed now."""
-    for pipeline in Pipeline.where(run_on_schedule=True).all():
-      logging.info('Checking schedules for pipeline %s', pipeline.name)
-      for schedule in pipeline.schedules:
-        logging.info('Checking schedule with cron string %s', schedule.cron)
-        if self._its_time(schedule.cron):
-          logging.info('Trying to start pipeline %s', pipeline.name)
-          pipeline.start()
-          break
+    expiration_datetime = datetime.now() - timedelta(self.RETENTION_DAYS)
+    TaskExecution.where(
+        status__in=TaskExecution.FINAL_STATUSES,
+        updated_at__lt=expiration_datetime
+    ).delete(synchronize_session=False)
+    # Blobs are touched whenever their params are enqueued again.
+    ParamsBlob.where(
+        updated_at__lt=expiration_datetime
+    ).delete(synchronize_session=False)
+    log_expiration_datetime = (datetime.utcnow()
+                               - timedelta(self.LOG_RETENTION_DAYS))
+    JobLog.where(
+        timestamp__lt=log_expiration_datetime
+    ).delete(synchronize_session=False)
     return 'OK', 200
 
 
 api.add_resource(Cron, '/cron')
+api.add_resource(ScheduledStart, '/cron/start')
+api.add_resource(Reaper, '/cron/reap')
+api.add_resource(Cleanup, '/cron/cleanup')
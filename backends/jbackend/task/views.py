@@ -16,10 +16,14 @@
 
 
 import json
+import os
+import time
 from flask import Blueprint
 from flask import request
 from flask_restful import Resource, reqparse
 from core.models import Job
+from core.models import ParamsBlob
+from core.models import TaskExecution
 from core import workers
 from jbackend.extensions import api
 
@@ -29,44 +33,153 @@ parser = reqparse.RequestParser()
 parser.add_argument('job_id')
 parser.add_argument('worker_class')
 parser.add_argument('worker_params')
+parser.add_argument('worker_params_ref')
+
+
+def _load_worker_params(args):
+  if args.get('worker_params_ref'):
+    return json.loads(ParamsBlob.load(args['worker_params_ref']))
+  return json.loads(args['worker_params'])
 
 
 class Task(Resource):
   """Lets you POST to add new task."""
 
+  # Number of seconds a task may spend running zero-delay follow-up workers
+  # in-process. Follow-ups left when it runs out are added to the queue.
+  INLINE_TIME_BUDGET = int(os.environ.get('INLINE_TIME_BUDGET', 60))
+
   def post(self):
     """
-    NB: you want retrieve the task name with this snippet
-
-        task_name = request.headers.get('X-AppEngine-TaskName')[11:]
-
+    NB: a task is recorded in the TaskExecution ledger under its name, so a
+        task redelivered after the worker has finished is acknowledged without
+        running the worker or updating the job counters again.
     """
+    started_at = time.time()
     retries = int(request.headers.get('X-AppEngine-TaskExecutionCount'))
+    task_name = request.headers.get('X-AppEngine-TaskName')
+    execution = None
+    if task_name is not None:
+      execution = TaskExecution.where(task_name=task_name).first()
+      if execution is not None and execution.finished:
+        return 'OK', 200
     args = parser.parse_args()
     job = Job.find(args['job_id'])
+    if task_name is not None and execution is None:
+      execution = TaskExecution.create(
+          task_name=task_name,
+          pipeline_id=job.pipeline_id,
+          job_id=job.id,
+          worker_class=args['worker_class'])
     worker_class = getattr(workers, args['worker_class'])
-    worker_params = json.loads(args['worker_params'])
-    worker = worker_class(worker_params, job.pipeline_id, job.id)
-    if retries >= worker_class.MAX_ATTEMPTS:
-      worker.log_error('Execution canceled after %i failed attempts', retries)
-      job.worker_failed()
-    elif job.status == 'stopping':
-      worker.log_warn('Execution canceled as parent job is going to stop')
-      job.worker_failed()
-    else:
-      try:
-        workers_to_enqueue = worker.execute()
-      except workers.WorkerException as e:
-        worker.log_error('Execution failed: %s: %s', e.__class__.__name__, e)
-        job.worker_failed()
-      except Exception as e:
-        worker.log_error('Unexpected error: %s: %s', e.__class__.__name__, e)
-        raise e
+    worker = worker_class(_load_worker_params(args), job.pipeline_id, job.id)
+    try:
+      if retries >= worker_class.MAX_ATTEMPTS:
+        worker.log_error('Execution canceled after %i failed attempts',
+                         retries)
+        job.worker_failed(execution)
+        worker.flush_logs()
       else:
-        for worker_class_name, worker_params, delay in workers_to_enqueue:
-          job.enqueue(worker_class_name, worker_params, delay)
-        job.worker_succeeded()
+        self._run_chain(job, worker, execution, task_name, started_at)
+    finally:
+      # Follow-ups run in-process may have freed up slots before a failure.
+      TaskExecution.dispatch_pending(job.pipeline_id, args['worker_class'])
     return 'OK', 200
 
+  def _run_chain(self, job, worker, execution, task_name, started_at):
+    """Runs a worker and the chain of zero-delay follow-ups it spawned.
+
+    NB: workers of the chain are counted as succeeded only once the chain
+        has finished or its rest has been dispatched to the queue. A request
+        dying in the middle of the chain leaves the task unfinished, so the
+        queue retries it and the follow-up left running is run again.
+    """
+    succeeded_executions = []
+    task_params = None
+    while True:
+      try:
+        succeeded, follow_up = self._run(job, worker, execution, task_name)
+      except Exception:  # pylint: disable=broad-except
+        if task_params is None:
+          raise
+        # Let the queue retry the follow-up.
+        execution.dispatch(task_params)
+        break
+      if not succeeded:
+        break
+      succeeded_executions.append(execution)
+      if follow_up is None:
+        break
+      execution = follow_up
+      task_name = execution.task_name
+      task_params = json.loads(execution.payload)
+      if time.time() - started_at > self.INLINE_TIME_BUDGET:
+        execution.dispatch(task_params)
+        break
+      worker_class = getattr(workers, execution.worker_class)
+      worker = worker_class(_load_worker_params(task_params),
+                            job.pipeline_id, job.id)
+    for execution in reversed(succeeded_executions):
+      job.worker_succeeded(execution)
+
+  def _run(self, job, worker, execution, task_name):
+    """Runs a worker and enqueues the workers it spawned.
+
+    Returns:
+      Tuple of whether the worker succeeded and the ledger entry of the
+      zero-delay follow-up to run in-process, if any. A failed worker is
+      counted right away, a succeeded one is left for the caller to count.
+    """
+    if job.status == 'stopping':
+      worker.log_warn('Execution canceled as parent job is going to stop')
+      job.worker_failed(execution)
+      worker.flush_logs()
+      return False, None
+    self._record(execution, 'running')
+    if execution is not None:
+      self._resume(worker, execution)
+    try:
+      workers_to_enqueue = worker.execute()
+    except workers.WorkerException as e:
+      worker.log_error('Execution failed: %s: %s', e.__class__.__name__, e)
+      job.add_retry_stats(*worker.retry_stats)
+      job.worker_failed(execution)
+      worker.flush_logs()
+      return False, None
+    except Exception as e:
+      worker.log_error('Unexpected error: %s: %s', e.__class__.__name__, e)
+      job.add_retry_stats(*worker.retry_stats)
+      worker.flush_logs()
+      raise e
+    job.add_retry_stats(*worker.retry_stats)
+    follow_up = None
+    for position, worker_to_enqueue in enumerate(workers_to_enqueue):
+      worker_class_name, worker_params, delay = worker_to_enqueue
+      worker_class = getattr(workers, worker_class_name, None)
+      run_inline = getattr(worker_class, 'RUN_INLINE', False)
+      # Siblings of a fan-out go to the queue to run in parallel.
+      inline = run_inline and follow_up is None and delay == 0
+      result = job.enqueue(worker_class_name, worker_params, delay,
+                           parent_task_name=task_name, position=position,
+                           inline=inline)
+      if inline and isinstance(result, TaskExecution):
+        follow_up = result
+    worker.flush_logs()
+    return True, follow_up
+
+  def _resume(self, worker, execution):
+    """Lets a worker resume from its checkpoint in the task ledger."""
+    checkpoint = None
+    if execution.checkpoint:
+      checkpoint = json.loads(execution.checkpoint)
+
+    def save(checkpoint):
+      execution.update(checkpoint=json.dumps(checkpoint))
+    worker.resume(checkpoint, save)
+
+  def _record(self, execution, status):
+    if execution is not None:
+      execution.update(status=status)
+
 
 api.add_resource(Task, '/task')
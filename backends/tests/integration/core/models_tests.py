@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+
+from google.appengine.api import taskqueue
 from google.appengine.ext import testbed
 import mock
 
@@ -516,3 +519,130 @@ class TestJobStartWithDependentJobs(utils.ModelTestCase):
     self.assertFalse(result)
     self.assertEqual(job2.status, 'failed')
     self.assertEqual(job3.status, 'failed')
+
+
+class TestJobConcurrencyLimits(utils.ModelTestCase):
+
+  def setUp(self):
+    super(TestJobConcurrencyLimits, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_taskqueue_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_app_identity_stub()
+
+  def tearDown(self):
+    super(TestJobConcurrencyLimits, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_enqueue_buffers_tasks_over_pipeline_limit(self):
+    pipeline = models.Pipeline.create(max_concurrent_tasks=1)
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            worker_class='Commenter')
+    self.assertIsNotNone(job.enqueue('Commenter', {}))
+    self.assertIsNone(job.enqueue('Commenter', {}))
+    self.assertEqual(job.enqueued_workers_count, 2)
+    self.assertEqual(
+        models.TaskExecution.where(status='pending').count(), 1)
+
+  def test_dispatch_pending_enqueues_buffered_tasks(self):
+    pipeline = models.Pipeline.create(max_concurrent_tasks=1)
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            worker_class='Commenter')
+    job.enqueue('Commenter', {})
+    job.enqueue('Commenter', {})
+    running = models.TaskExecution.where(status='enqueued').first()
+    job.worker_succeeded(running)
+    models.TaskExecution.dispatch_pending(pipeline.id, 'Commenter')
+    self.assertEqual(
+        models.TaskExecution.where(status='pending').count(), 0)
+    self.assertEqual(
+        models.TaskExecution.where(status='enqueued').count(), 1)
+    self.assertEqual(models.TaskSlot.find('pipeline:%i' % pipeline.id).taken,
+                     1)
+
+  def test_dispatch_pending_skips_tasks_over_other_caps(self):
+    pipeline1 = models.Pipeline.create(max_concurrent_tasks=1)
+    job1 = models.Job.create(pipeline_id=pipeline1.id, status='running',
+                             worker_class='Commenter')
+    pipeline2 = models.Pipeline.create(max_concurrent_tasks=1)
+    job2 = models.Job.create(pipeline_id=pipeline2.id, status='running',
+                             worker_class='Commenter')
+    job1.enqueue('Commenter', {})
+    job1.enqueue('Commenter', {})
+    job2.enqueue('Commenter', {})
+    job2.enqueue('Commenter', {})
+    running = models.TaskExecution.where(job_id=job2.id,
+                                         status='enqueued').first()
+    job2.worker_succeeded(running)
+    models.TaskExecution.dispatch_pending()
+    self.assertEqual(models.TaskExecution.where(
+        job_id=job1.id, status='pending').count(), 1)
+    self.assertEqual(models.TaskExecution.where(
+        job_id=job2.id, status='pending').count(), 0)
+
+  def test_reap_fails_lost_tasks_and_frees_up_their_slots(self):
+    pipeline = models.Pipeline.create(max_concurrent_tasks=1)
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            worker_class='Commenter')
+    job.enqueue('Commenter', {})
+    models.TaskExecution.where(status='enqueued').update(
+        {models.TaskExecution.updated_at: datetime(2018, 1, 1)},
+        synchronize_session=False)
+    self.assertEqual(models.TaskExecution.reap(datetime(2018, 1, 2)), 1)
+    self.assertEqual(models.Job.find(job.id).status, 'failed')
+    self.assertEqual(models.TaskSlot.find('pipeline:%i' % pipeline.id).taken,
+                     0)
+
+
+class TestTaskExecutionLedger(utils.ModelTestCase):
+
+  def setUp(self):
+    super(TestTaskExecutionLedger, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_taskqueue_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_app_identity_stub()
+
+  def tearDown(self):
+    super(TestTaskExecutionLedger, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_worker_outcome_is_counted_once(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            enqueued_workers_count=2)
+    execution = models.TaskExecution.create(
+        task_name='task_1', job_id=job.id, worker_class='Commenter',
+        status='running')
+    job.worker_succeeded(execution)
+    job.worker_succeeded(execution)
+    job = models.Job.find(job.id)
+    self.assertEqual(job.succeeded_workers_count, 1)
+    self.assertEqual(job.status, 'running')
+    execution = models.TaskExecution.find(execution.id)
+    self.assertEqual(execution.status, 'succeeded')
+
+  def test_enqueue_keeps_increments_of_other_requests(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            worker_class='Commenter', enqueued_workers_count=1)
+    # Another request enqueues a task of the job in the meantime.
+    models.Job.query.filter(models.Job.id == job.id).update(
+        {models.Job.enqueued_workers_count: 2}, synchronize_session=False)
+    job.enqueue('Commenter', {})
+    self.assertEqual(job.enqueued_workers_count, 3)
+
+  @mock.patch('google.appengine.api.taskqueue.add')
+  def test_enqueue_drops_entry_of_task_not_added(self, patched_add):
+    patched_add.side_effect = taskqueue.TransientError()
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            worker_class='Commenter')
+    with self.assertRaises(taskqueue.TransientError):
+      job.enqueue('Commenter', {})
+    self.assertEqual(models.TaskExecution.query.count(), 0)
+    self.assertEqual(models.Job.find(job.id).enqueued_workers_count, 0)
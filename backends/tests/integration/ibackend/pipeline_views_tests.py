@@ -12,6 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+
+from google.appengine.ext import testbed
+import mock
+
+from core import models
 from tests import utils
 
 
@@ -28,3 +34,83 @@ class TestPipelineList(utils.IBackendBaseTest):
     """
     response = self.client.get('/api/pipelines')
     self.assertEqual(response.status_code, 200)
+
+
+class TestPipelineLogs(utils.IBackendBaseTest):
+
+  def setUp(self):
+    super(TestPipelineLogs, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    self.pipeline = models.Pipeline.create()
+    self.job = models.Job.create(name='Job', pipeline_id=self.pipeline.id)
+    entries = []
+    for i in xrange(25):
+      entries.append(({
+          'labels': {
+              'pipeline_id': self.pipeline.id,
+              'job_id': self.job.id,
+              'worker_class': 'Commenter',
+          },
+          'log_level': 'ERROR' if i % 5 == 0 else 'INFO',
+          'message': 'Message %i' % i,
+      }, datetime.utcnow()))
+    models.JobLog.add_entries(entries)
+
+  def tearDown(self):
+    super(TestPipelineLogs, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_list_logs_by_pages(self):
+    url = '/api/pipelines/%i/logs' % self.pipeline.id
+    response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(len(response.json['entries']), 20)
+    self.assertEqual(response.json['entries'][0]['payload']['message'],
+                     'Message 24')
+    self.assertEqual(response.json['entries'][0]['job_name'], 'Job')
+    next_page_token = response.json['next_page_token']
+    response = self.client.get(url, query_string={
+        'next_page_token': next_page_token})
+    self.assertEqual(len(response.json['entries']), 5)
+    self.assertIsNone(response.json['next_page_token'])
+
+  def test_filter_logs_by_level(self):
+    url = '/api/pipelines/%i/logs' % self.pipeline.id
+    response = self.client.get(url, query_string={'log_level': 'ERROR'})
+    self.assertEqual(len(response.json['entries']), 5)
+
+  def test_next_page_is_prefetched(self):
+    url = '/api/pipelines/%i/logs' % self.pipeline.id
+    response = self.client.get(url)
+    next_page_token = response.json['next_page_token']
+    with mock.patch('core.models.JobLog.where') as patched_where:
+      response = self.client.get(url, query_string={
+          'next_page_token': next_page_token})
+    patched_where.assert_not_called()
+    self.assertEqual(len(response.json['entries']), 5)
+    self.assertEqual(response.json['entries'][0]['payload']['message'],
+                     'Message 4')
+
+
+class TestPipelineSpool(utils.IBackendBaseTest):
+
+  def test_spool_summary(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(name='Job', pipeline_id=pipeline.id)
+    models.SpooledBatch.spool(pipeline.id, job.id, [
+        ('v=1&cid=1\nv=1&cid=2', 'http_500'),
+        ('v=1&cid=3', 'http_500'),
+    ])
+    url = '/api/pipelines/%i/spool' % pipeline.id
+    response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.json['entries'], [{
+        'job_id': job.id,
+        'job_name': 'Job',
+        'reason': 'http_500',
+        'batches_count': 2,
+        'hits_count': 3,
+    }])
@@ -12,3 +12,89 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+
+from datetime import datetime
+
+from freezegun import freeze_time
+from google.appengine.ext import testbed
+import mock
+
+from core import models
+
+from tests import utils
+
+
+class TestCron(utils.JBackendBaseTest):
+
+  def setUp(self):
+    super(TestCron, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_taskqueue_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_app_identity_stub()
+
+  def tearDown(self):
+    super(TestCron, self).tearDown()
+    self.testbed.deactivate()
+
+  @mock.patch('core.models.Schedule.enqueue_start')
+  def test_missed_schedule_is_started_once(self, patched_enqueue_start):
+    pipeline = models.Pipeline.create(run_on_schedule=True)
+    with freeze_time('2018-06-11 10:00:00'):
+      schedule = models.Schedule.create(pipeline_id=pipeline.id,
+                                        cron='*/5 * * * *')
+    with freeze_time('2018-06-11 10:17:30'):
+      response = self.client.get('/cron')
+    self.assertEqual(response.status_code, 200)
+    patched_enqueue_start.assert_called_once()
+    schedule = models.Schedule.find(schedule.id)
+    self.assertEqual(schedule.next_run_at, datetime(2018, 6, 11, 10, 20))
+
+  @mock.patch('core.models.Schedule.enqueue_start')
+  def test_schedule_not_due_is_skipped(self, patched_enqueue_start):
+    pipeline = models.Pipeline.create(run_on_schedule=True)
+    with freeze_time('2018-06-11 10:00:00'):
+      models.Schedule.create(pipeline_id=pipeline.id, cron='0 12 * * *')
+    with freeze_time('2018-06-11 10:17:30'):
+      self.client.get('/cron')
+    patched_enqueue_start.assert_not_called()
+
+  @mock.patch('core.models.Schedule.enqueue_start')
+  def test_pipeline_off_schedule_is_skipped(self, patched_enqueue_start):
+    pipeline = models.Pipeline.create(run_on_schedule=False)
+    with freeze_time('2018-06-11 10:00:00'):
+      schedule = models.Schedule.create(pipeline_id=pipeline.id,
+                                        cron='*/5 * * * *')
+    with freeze_time('2018-06-11 10:17:30'):
+      self.client.get('/cron')
+    patched_enqueue_start.assert_not_called()
+    schedule = models.Schedule.find(schedule.id)
+    self.assertEqual(schedule.next_run_at, datetime(2018, 6, 11, 10, 5))
+    with freeze_time('2018-06-11 10:18:30'):
+      pipeline.update(run_on_schedule=True)
+      self.client.get('/cron')
+    patched_enqueue_start.assert_not_called()
+    schedule = models.Schedule.find(schedule.id)
+    self.assertEqual(schedule.next_run_at, datetime(2018, 6, 11, 10, 20))
+
+  @mock.patch('core.models.Schedule.get_next_run_at')
+  def test_invalid_cron_is_left_alone(self, patched_get_next_run_at):
+    pipeline = models.Pipeline.create(run_on_schedule=True)
+    patched_get_next_run_at.return_value = None
+    schedule = models.Schedule.create(pipeline_id=pipeline.id, cron='INVALID')
+    self.assertFalse(schedule.is_valid)
+    self.client.get('/cron')
+    patched_get_next_run_at.assert_called_once()
+
+  @mock.patch('core.models.Pipeline.start')
+  def test_scheduled_start_runs_once_per_fire_time(self, patched_start):
+    pipeline = models.Pipeline.create(run_on_schedule=True)
+    schedule = models.Schedule.create(pipeline_id=pipeline.id,
+                                      cron='0 12 * * *')
+    data = dict(schedule_id=schedule.id, fire_timestamp=1528718400)
+    response = self.client.post('/cron/start', data=data)
+    self.assertEqual(response.status_code, 200)
+    self.client.post('/cron/start', data=data)
+    patched_start.assert_called_once()
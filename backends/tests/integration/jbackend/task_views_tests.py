@@ -20,6 +20,10 @@ from core import models
 from tests import utils
 
 
+class _RequestDied(BaseException):
+  """Stands for errors skipping except Exception, e.g. DeadlineExceeded."""
+
+
 class TestTaskCreation(utils.JBackendBaseTest):
 
   def setUp(self):
@@ -54,3 +58,109 @@ class TestTaskCreation(utils.JBackendBaseTest):
         'X-AppEngine-TaskExecutionCount': '0'}
     response = self.client.post('/task', headers=headers, data=data)
     self.assertEqual(response.status_code, 200)
+
+  @mock.patch('core.logging.logger')
+  def test_redelivered_finished_task_is_skipped(self, patched_logger):
+    patched_logger.log_struct.__name__ = 'foo'
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            enqueued_workers_count=1)
+    models.TaskExecution.create(
+        task_name='task_1', job_id=job.id, worker_class='Commenter',
+        status='succeeded')
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}')
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0',
+        'X-AppEngine-TaskName': 'task_1'}
+    response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    job = models.Job.find(job.id)
+    self.assertEqual(job.succeeded_workers_count, 0)
+    patched_logger.batch.assert_not_called()
+
+  @mock.patch('core.logging.logger')
+  def test_zero_delay_follow_up_runs_inline(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            enqueued_workers_count=1)
+    follow_up = ('Commenter', {'comment': '', 'success': True}, 0)
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}')
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0',
+        'X-AppEngine-TaskName': 'task_1'}
+    with mock.patch('core.workers.Commenter.execute',
+                    side_effect=[[follow_up], []]) as patched_execute, \
+        mock.patch('google.appengine.api.taskqueue.add') as patched_add:
+      response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(patched_execute.call_count, 2)
+    patched_add.assert_not_called()
+    job = models.Job.find(job.id)
+    self.assertEqual(job.enqueued_workers_count, 2)
+    self.assertEqual(job.succeeded_workers_count, 2)
+    self.assertEqual(job.status, 'succeeded')
+
+  @mock.patch('core.logging.logger')
+  def test_follow_up_left_running_is_run_again(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            enqueued_workers_count=1)
+    follow_up = ('Commenter', {'comment': '', 'success': True}, 0)
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}')
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0',
+        'X-AppEngine-TaskName': 'task_1'}
+    with mock.patch('core.workers.Commenter.execute',
+                    side_effect=[[follow_up], _RequestDied()]), \
+        mock.patch('google.appengine.api.taskqueue.add'):
+      with self.assertRaises(_RequestDied):
+        self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(models.TaskExecution.where(
+        task_name='task_1').first().status, 'running')
+    self.assertEqual(models.Job.find(job.id).succeeded_workers_count, 0)
+    headers['X-AppEngine-TaskExecutionCount'] = '1'
+    with mock.patch('core.workers.Commenter.execute',
+                    side_effect=[[follow_up], []]) as patched_execute, \
+        mock.patch('google.appengine.api.taskqueue.add') as patched_add:
+      response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(patched_execute.call_count, 2)
+    patched_add.assert_not_called()
+    job = models.Job.find(job.id)
+    self.assertEqual(job.enqueued_workers_count, 2)
+    self.assertEqual(job.succeeded_workers_count, 2)
+    self.assertEqual(job.status, 'succeeded')
+
+  @mock.patch('core.logging.logger')
+  def test_fan_out_siblings_are_dispatched(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, status='running',
+                            enqueued_workers_count=1)
+    follow_up = ('Commenter', {'comment': '', 'success': True}, 0)
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}')
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0',
+        'X-AppEngine-TaskName': 'task_1'}
+    with mock.patch('core.workers.Commenter.execute',
+                    side_effect=[[follow_up] * 3, []]) as patched_execute, \
+        mock.patch('google.appengine.api.taskqueue.add') as patched_add:
+      response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(patched_execute.call_count, 2)
+    self.assertEqual(patched_add.call_count, 2)
+    job = models.Job.find(job.id)
+    self.assertEqual(job.enqueued_workers_count, 4)
+    self.assertEqual(job.succeeded_workers_count, 2)
+    self.assertEqual(job.status, 'running')
@@ -0,0 +1,58 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from google.appengine.ext import testbed
+import mock
+
+from core import circuitbreaker
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+  def setUp(self):
+    super(TestCircuitBreaker, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    patcher_services = mock.patch.dict(circuitbreaker.SERVICES,
+                                       {'test': (2, 60)})
+    self.addCleanup(patcher_services.stop)
+    patcher_services.start()
+
+  def tearDown(self):
+    super(TestCircuitBreaker, self).tearDown()
+    self.testbed.deactivate()
+
+  @mock.patch('time.time')
+  def test_opens_after_consecutive_failures(self, patched_time):
+    patched_time.return_value = 1000.0
+    self.assertFalse(circuitbreaker.record_failure('test'))
+    self.assertEqual(circuitbreaker.retry_after('test'), 0)
+    self.assertTrue(circuitbreaker.record_failure('test'))
+    patched_time.return_value = 1030.0
+    self.assertEqual(circuitbreaker.retry_after('test'), 30)
+
+  def test_success_resets_failures(self):
+    circuitbreaker.record_failure('test')
+    circuitbreaker.record_success('test')
+    self.assertFalse(circuitbreaker.record_failure('test'))
+    self.assertEqual(circuitbreaker.retry_after('test'), 0)
+
+  def test_reopens_after_single_failure_once_half_open(self):
+    circuitbreaker.record_failure('test')
+    circuitbreaker.record_failure('test')
+    self.assertTrue(circuitbreaker.record_failure('test'))
@@ -0,0 +1,60 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+
+from core import logging
+
+
+class TestLogBuffer(unittest.TestCase):
+
+  def setUp(self):
+    super(TestLogBuffer, self).setUp()
+    patcher_add_entries = mock.patch('core.models.JobLog.add_entries')
+    self.addCleanup(patcher_add_entries.stop)
+    self.patched_add_entries = patcher_add_entries.start()
+
+  @mock.patch('core.logging.logger')
+  def test_flush_writes_entries_in_one_batch(self, patched_logger):
+    log_buffer = logging.LogBuffer()
+    log_buffer.log_struct({'message': 'foo'})
+    log_buffer.log_struct({'message': 'bar'})
+    patched_logger.batch.assert_not_called()
+    log_buffer.flush()
+    batch = patched_logger.batch.return_value
+    self.assertEqual(batch.log_struct.call_count, 2)
+    batch.commit.assert_called_once()
+    stored_entries = self.patched_add_entries.call_args[0][0]
+    self.assertEqual([info for info, _ in stored_entries],
+                     [{'message': 'foo'}, {'message': 'bar'}])
+
+  @mock.patch('core.logging.logger')
+  def test_flush_when_buffer_is_full(self, patched_logger):
+    log_buffer = logging.LogBuffer()
+    for i in xrange(log_buffer.MAX_ENTRIES):
+      log_buffer.log_struct({'message': 'foo %i' % i})
+    batch = patched_logger.batch.return_value
+    self.assertEqual(batch.log_struct.call_count, log_buffer.MAX_ENTRIES)
+
+  @mock.patch('sys.stderr')
+  @mock.patch('core.logging.logger')
+  def test_failed_flush_falls_back_to_stderr(self, patched_logger,
+                                             patched_stderr):
+    patched_logger.batch.return_value.commit.side_effect = ValueError()
+    log_buffer = logging.LogBuffer()
+    log_buffer.log_struct({'message': 'foo'})
+    log_buffer.flush()
+    self.assertEqual(patched_stderr.write.call_count, 2)
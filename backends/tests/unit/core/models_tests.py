@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+
+from freezegun import freeze_time
 from google.appengine.ext import testbed
 import mock
 
@@ -222,6 +225,50 @@ class TestJob(utils.ModelTestCase):
     self.assertEqual(len(job1.params.all()), 1)
 
 
+class TestParamsBlob(utils.ModelTestCase):
+
+  def test_store_is_content_addressed(self):
+    ref1 = models.ParamsBlob.store('{"view_ids": ["1", "2"]}')
+    ref2 = models.ParamsBlob.store('{"view_ids": ["1", "2"]}')
+    self.assertEqual(ref1, ref2)
+    self.assertEqual(models.ParamsBlob.query.count(), 1)
+
+  def test_load_returns_stored_value(self):
+    ref = models.ParamsBlob.store('{"view_ids": ["1", "2"]}')
+    self.assertEqual(models.ParamsBlob.load(ref), '{"view_ids": ["1", "2"]}')
+
+  def test_store_again_refreshes_updated_at(self):
+    ref = models.ParamsBlob.store('{"view_ids": ["1", "2"]}')
+    models.ParamsBlob.where(id=ref).update(
+        {models.ParamsBlob.updated_at: datetime(2018, 1, 1)},
+        synchronize_session=False)
+    models.ParamsBlob.store('{"view_ids": ["1", "2"]}')
+    self.assertEqual(models.ParamsBlob.where(
+        id=ref, updated_at__lt=datetime(2018, 1, 2)).count(), 0)
+
+  def test_store_tolerates_concurrent_insert(self):
+    ref = models.ParamsBlob.store('{"view_ids": ["1", "2"]}')
+    with mock.patch.object(models.ParamsBlob, '_touch', return_value=False):
+      self.assertEqual(models.ParamsBlob.store('{"view_ids": ["1", "2"]}'),
+                       ref)
+    self.assertEqual(models.ParamsBlob.query.count(), 1)
+
+
+class TestSchedule(utils.ModelTestCase):
+
+  @freeze_time('2018-06-11 10:30:00')
+  def test_next_run_at_follows_cron(self):
+    schedule = models.Schedule.create(cron='0 * * * *')
+    self.assertEqual(schedule.next_run_at, datetime(2018, 6, 11, 11, 0))
+    schedule.update(cron='45 10 * * *')
+    self.assertEqual(schedule.next_run_at, datetime(2018, 6, 11, 10, 45))
+
+  def test_next_run_at_is_empty_for_invalid_cron(self):
+    schedule = models.Schedule.create(cron='INVALID')
+    self.assertIsNone(schedule.next_run_at)
+    self.assertFalse(schedule.is_valid)
+
+
 class TestParam(utils.ModelTestCase):
 
   def test_job_id_and_pipeline_id_mutually_exclusive(self):
@@ -320,3 +367,20 @@ class TestStage(utils.ModelTestCase):
     self.assertNotEqual(st.sid, '123')
     st.assign_attributes(attrs)
     self.assertEqual(st.sid, '123')
+
+
+class TestSpooledBatch(utils.ModelTestCase):
+
+  def test_summary_by_job_and_reason(self):
+    models.SpooledBatch.spool(1, 1, [
+        ('v=1&cid=1\nv=1&cid=2', 'http_500'),
+        ('v=1&cid=3', 'http_500'),
+        ('v=1&cid=4', 'timeout'),
+    ])
+    models.SpooledBatch.spool(2, 3, [('v=1&cid=5', 'http_500')])
+    summary = sorted(models.SpooledBatch.summary(1))
+    self.assertEqual([(job_id, reason, batches, int(hits))
+                      for job_id, reason, batches, hits in summary], [
+                          (1, 'http_500', 2, 3),
+                          (1, 'timeout', 1, 1),
+                      ])
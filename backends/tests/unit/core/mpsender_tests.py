@@ -0,0 +1,123 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import unittest
+
+from core import mpsender
+
+
+class TestEncoder(unittest.TestCase):
+
+  def test_encode_row(self):
+    encoder = mpsender.Encoder(['cid', 'el', 'ev'], {'v': 1})
+    self.assertEqual(encoder.encode(['c 1', u'\xe9t\xe9', 0.5]),
+                     'v=1&cid=c+1&el=%C3%A9t%C3%A9&ev=0.5')
+
+  def test_none_values_and_overridden_defaults_are_left_out(self):
+    encoder = mpsender.Encoder(['v', 'cid', 'el'], {'v': 1})
+    self.assertEqual(encoder.encode([2, 'c1', None]), 'v=2&cid=c1')
+
+
+class TestBatchPacker(unittest.TestCase):
+
+  def test_batches_are_cut_by_hits_count(self):
+    packer = mpsender.BatchPacker(max_hits=2)
+    self.assertEqual(packer.add('a'), [])
+    self.assertEqual(packer.add('b'), ['a\nb'])
+    self.assertEqual(packer.add('c'), [])
+    self.assertEqual(packer.pending_count, 1)
+    self.assertEqual(packer.flush(), 'c')
+    self.assertIsNone(packer.flush())
+
+  def test_batches_are_cut_by_bytes(self):
+    packer = mpsender.BatchPacker(max_hits=20, max_bytes=10)
+    self.assertEqual(packer.add('aaaa'), [])
+    self.assertEqual(packer.add('bbbbb'), [])
+    self.assertEqual(packer.add('c'), ['aaaa\nbbbbb'])
+    self.assertEqual(packer.flush(), 'c')
+
+  def test_hits_count_is_capped(self):
+    self.assertEqual(mpsender.BatchPacker(max_hits=50).max_hits, 20)
+
+
+class _StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Stand-in Measurement Protocol endpoint keeping connections alive."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections_count += 1
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    length = int(self.headers.getheader('content-length'))
+    self.server.payloads.append(self.rfile.read(length))
+    status = 500 if self.path == '/error' else 200
+    self.send_response(status)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
+class TestSender(unittest.TestCase):
+
+  def setUp(self):
+    super(TestSender, self).setUp()
+    self.server = _StandInServer(('127.0.0.1', 0), _StandInHandler)
+    self.server.connections_count = 0
+    self.server.payloads = []
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    self.endpoint = 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+  def test_batches_reuse_connections(self):
+    sender = mpsender.Sender(endpoint=self.endpoint + '/batch',
+                             max_in_flight=2)
+    payloads = ['cid=%i' % i for i in xrange(10)]
+    responses = sender.map(lambda p: sender.post(p, 'CRMint / 0.1'),
+                           payloads)
+    self.assertEqual([r.status_code for r in responses], [200] * 10)
+    self.assertEqual(sorted(self.server.payloads), sorted(payloads))
+    self.assertLessEqual(self.server.connections_count, 2)
+    self.assertEqual(len(sender.latencies), 10)
+    self.assertEqual(sender.status_counts, {200: 10})
+
+  def test_summary_counts_statuses(self):
+    sender = mpsender.Sender(endpoint=self.endpoint + '/error')
+    sender.post('cid=1', 'CRMint / 0.1')
+    self.assertEqual(sender.status_counts, {500: 1})
+    self.assertIn('1 batches sent', sender.summary())
+    self.assertIn('500: 1', sender.summary())
+
+  def test_map_raises_first_error(self):
+    sender = mpsender.Sender(max_in_flight=3)
+    def _fail(item):
+      if item == 2:
+        raise ValueError(item)
+      return item
+    with self.assertRaises(ValueError):
+      sender.map(_fail, [1, 2, 3])
+    self.assertEqual(sender.map(_fail, [1, 3]), [1, 3])
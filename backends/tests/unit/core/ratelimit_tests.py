@@ -0,0 +1,59 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from google.appengine.ext import testbed
+import mock
+
+from core import ratelimit
+
+
+class TestAcquire(unittest.TestCase):
+
+  def setUp(self):
+    super(TestAcquire, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    patcher_rates = mock.patch.dict(ratelimit.RATES, {'test': (1.0, 2)})
+    self.addCleanup(patcher_rates.stop)
+    patcher_rates.start()
+
+  def tearDown(self):
+    super(TestAcquire, self).tearDown()
+    self.testbed.deactivate()
+
+  @mock.patch('time.time')
+  def test_acquire_until_bucket_is_empty(self, patched_time):
+    patched_time.return_value = 1000.0
+    self.assertEqual(ratelimit.acquire('test'), 0)
+    self.assertEqual(ratelimit.acquire('test'), 0)
+    self.assertEqual(ratelimit.acquire('test'), 1.0)
+
+  @mock.patch('time.time')
+  def test_acquire_after_bucket_refill(self, patched_time):
+    patched_time.return_value = 1000.0
+    ratelimit.acquire('test')
+    ratelimit.acquire('test')
+    patched_time.return_value = 1001.0
+    self.assertEqual(ratelimit.acquire('test'), 0)
+
+  @mock.patch('time.time')
+  def test_keys_have_separate_buckets(self, patched_time):
+    patched_time.return_value = 1000.0
+    ratelimit.acquire('test', 'UA-1')
+    ratelimit.acquire('test', 'UA-1')
+    self.assertEqual(ratelimit.acquire('test', 'UA-2'), 0)
@@ -0,0 +1,41 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from core import threadpool
+
+
+class TestBoundedMap(unittest.TestCase):
+
+  def test_results_keep_order_of_items(self):
+    self.assertEqual(threadpool.bounded_map(lambda i: i * 2, range(10), 3),
+                     [i * 2 for i in range(10)])
+
+  def test_calls_are_bounded(self):
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+    def _call(_):
+      with lock:
+        running[0] += 1
+        max_running[0] = max(max_running[0], running[0])
+      time.sleep(0.01)
+      with lock:
+        running[0] -= 1
+    threadpool.bounded_map(_call, range(20), 4)
+    self.assertLessEqual(max_running[0], 4)
+    self.assertGreater(max_running[0], 1)
@@ -12,18 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+from datetime import timedelta
+import json
 import os
+import shutil
+import tempfile
 import unittest
 
 from apiclient.errors import HttpError
 import cloudstorage
 from google.appengine.ext import testbed
 from google.cloud.bigquery.dataset import Dataset
+from google.cloud.bigquery.schema import SchemaField
 from google.cloud.bigquery.table import Table
 from google.cloud.exceptions import ClientError
 import mock
 
+from core import models
 from core import workers
+from tests import utils
 
 
 class TestAbstractWorker(unittest.TestCase):
@@ -53,31 +61,40 @@ class TestAbstractWorker(unittest.TestCase):
   @mock.patch('core.logging.logger')
   def test_log_info_succeeds(self, patched_logger):
     patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_info('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    self.assertEqual(batch.log_struct.call_count, 0)
+    worker.flush_logs()
+    self.assertEqual(batch.log_struct.call_count, 1)
+    batch.commit.assert_called_once()
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'INFO')
 
   @mock.patch('core.logging.logger')
   def test_log_warn_succeeds(self, patched_logger):
     patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_warn('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    self.assertEqual(batch.log_struct.call_count, 0)
+    worker.flush_logs()
+    self.assertEqual(batch.log_struct.call_count, 1)
+    batch.commit.assert_called_once()
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'WARNING')
 
   @mock.patch('core.logging.logger')
   def test_log_error_succeeds(self, patched_logger):
     patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_error('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    self.assertEqual(batch.log_struct.call_count, 0)
+    worker.flush_logs()
+    self.assertEqual(batch.log_struct.call_count, 1)
+    batch.commit.assert_called_once()
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'ERROR')
 
   @mock.patch('core.logging.logger')
@@ -106,14 +123,120 @@ class TestAbstractWorker(unittest.TestCase):
     # NB: bypass the time.sleep wait, otherwise the test will take ages
     patched_time_sleep.side_effect = lambda delay: delay
     worker = workers.Worker({}, 1, 1)
-    def _raise_value_error_exception(*args, **kwargs):
-      raise ValueError('Wrong value.')
+    worker._deferrable = False
+    def _raise_server_error_exception(*args, **kwargs):
+      raise HttpError(mock.Mock(status=503), '')
     fake_request = mock.Mock()
     fake_request.__name__ = 'foo'
-    fake_request.side_effect = _raise_value_error_exception
+    fake_request.side_effect = _raise_server_error_exception
+    with self.assertRaises(HttpError):
+      worker.retry(fake_request)()
+    self.assertEqual(fake_request.call_count,
+                     workers.Worker.RETRY_POLICY.max_attempts)
+    self.assertEqual(worker.retry_stats[0], fake_request.call_count - 1)
+
+  def test_retry_raises_error_if_not_retryable(self):
+    worker = workers.Worker({}, 1, 1)
+    fake_request = mock.Mock()
+    fake_request.__name__ = 'foo'
+    fake_request.side_effect = ValueError('Wrong value.')
     with self.assertRaises(ValueError):
       worker.retry(fake_request)()
-    self.assertGreaterEqual(fake_request.call_count, 2)
+    self.assertEqual(fake_request.call_count, 1)
+
+  @mock.patch('time.sleep')
+  def test_retry_defers_worker_on_long_backoff(self, patched_time_sleep):
+    worker = workers.Worker({}, 1, 1)
+    policy = workers.RetryPolicy(base_delay=60)
+    fake_request = mock.Mock()
+    fake_request.__name__ = 'foo'
+    fake_request.side_effect = HttpError(mock.Mock(status=429), '')
+    with self.assertRaises(workers.WorkerDeferred):
+      worker.retry(fake_request, policy=policy)()
+    self.assertEqual(fake_request.call_count, 1)
+    patched_time_sleep.assert_not_called()
+
+  @mock.patch('time.sleep')
+  @mock.patch('core.logging.logger')
+  def test_deferred_attempts_count_against_the_policy(self, patched_logger,
+                                                      patched_time_sleep):
+    patched_logger.log_struct.__name__ = 'foo'
+    policy = workers.RetryPolicy(max_attempts=4, jitter=0)
+    fake_request = mock.Mock()
+    fake_request.__name__ = 'foo'
+    fake_request.side_effect = HttpError(mock.Mock(status=503), '')
+
+    class DummyWorker(workers.Worker):
+      def _execute(self):
+        self.retry(fake_request, policy=policy)()
+    params = {}
+    deferrals_count = 0
+    with self.assertRaises(HttpError):
+      while True:
+        params = DummyWorker(params, 1, 1).execute()[0][1]
+        deferrals_count += 1
+    # Delays of 5 and 10 seconds are slept, that of 20 seconds defers the
+    # worker, whose re-run makes the last attempt.
+    self.assertEqual(deferrals_count, 1)
+    self.assertEqual(fake_request.call_count, 4)
+
+  @mock.patch('core.logging.logger')
+  def test_execute_deferred_worker_enqueues_itself(self, patched_logger):
+    patched_logger.log_struct.__name__ = 'foo'
+    class DummyWorker(workers.Worker):
+      def _execute(self):
+        raise workers.WorkerDeferred(42.5)
+    worker = DummyWorker({'param': 'value'}, 1, 1)
+    workers_to_enqueue = worker.execute()
+    self.assertEqual(workers_to_enqueue,
+                     [('DummyWorker', {'param': 'value'}, 43)])
+
+  @mock.patch('core.logging.logger')
+  def test_deferred_worker_carries_its_checkpoint(self, patched_logger):
+    class DummyWorker(workers.Worker):
+      def _execute(self):
+        self._save_checkpoint(offset=10)
+        raise workers.WorkerDeferred(1)
+    saver = mock.Mock()
+    worker = DummyWorker({'param': 'value'}, 1, 1)
+    worker.resume(None, saver)
+    workers_to_enqueue = worker.execute()
+    saver.assert_called_once_with({'offset': 10})
+    params = workers_to_enqueue[0][1]
+    self.assertEqual(params['_checkpoint'], {'offset': 10})
+    resumed_worker = DummyWorker(params, 1, 1)
+    self.assertEqual(resumed_worker._checkpoint, {'offset': 10})
+    self.assertNotIn('_checkpoint', resumed_worker._params)
+
+  @mock.patch('core.ratelimit.acquire')
+  def test_acquire_token_defers_on_long_wait(self, patched_acquire):
+    patched_acquire.return_value = 60
+    worker = workers.Worker({}, 1, 1)
+    with self.assertRaises(workers.WorkerDeferred):
+      worker._acquire_token('ga_reporting')
+
+  @mock.patch('core.circuitbreaker.retry_after')
+  def test_retry_defers_worker_while_circuit_is_open(self,
+                                                     patched_retry_after):
+    patched_retry_after.return_value = 30
+    worker = workers.Worker({}, 1, 1)
+    fake_request = mock.Mock()
+    fake_request.__name__ = 'foo'
+    with self.assertRaises(workers.WorkerDeferred):
+      worker.retry(fake_request, service='ga_v4')()
+    fake_request.assert_not_called()
+
+  @mock.patch('core.circuitbreaker.record_failure')
+  def test_retry_reports_retryable_failures_to_circuit(self,
+                                                       patched_record_failure):
+    worker = workers.Worker({}, 1, 1)
+    worker._deferrable = False
+    fake_request = mock.Mock()
+    fake_request.__name__ = 'foo'
+    fake_request.side_effect = [HttpError(mock.Mock(status=503), ''), 'OK']
+    with mock.patch('time.sleep'):
+      self.assertEqual(worker.retry(fake_request, service='ga_v4')(), 'OK')
+    patched_record_failure.assert_called_once_with('ga_v4')
 
   def test_retry_raises_error_if_bad_request_error(self):
     worker = workers.Worker({}, 1, 1)
@@ -129,21 +252,36 @@ class TestAbstractWorker(unittest.TestCase):
 
 class TestBQWorker(unittest.TestCase):
 
+  def setUp(self):
+    super(TestBQWorker, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    super(TestBQWorker, self).tearDown()
+    self.testbed.deactivate()
+
   @mock.patch('time.sleep')
   @mock.patch('google.cloud.bigquery.job.QueryJob')
+  @mock.patch('core.workers.BQ_INLINE_WAIT', 60)
   def test_begin_and_wait_start_jobs(self, patched_bigquery_QueryJob,
       patched_time_sleep):
     # NB: bypass the time.sleep wait, otherwise the test will take ages
     patched_time_sleep.side_effect = lambda delay: delay
-    worker = workers.BQWorker({}, 1, 1)
+    worker = workers.BQWorker({'bq_project_id': 'BQID'}, 1, 1)
     job0 = patched_bigquery_QueryJob()
     job0.begin.side_effect = lambda: True
+
     def _mark_as_done():
       job0.state = 'DONE'
     job0.reload.side_effect = _mark_as_done
     job0.error_result = None
     worker._begin_and_wait(job0)
     job0.begin.assert_called_once()
+    # Jobs done within BQ_INLINE_WAIT are not handed off to BQWaiter.
+    self.assertEqual(worker._workers_to_enqueue, [])
 
   @mock.patch('time.sleep')
   @mock.patch('google.cloud.bigquery.job.QueryJob')
@@ -160,13 +298,40 @@ class TestBQWorker(unittest.TestCase):
     job0 = patched_bigquery_QueryJob()
     job0.error_result = None
     worker._begin_and_wait(job0)
+    job0.begin.assert_called_once()
+    # With no inline wait, jobs are handed off right after they are begun.
+    job0.reload.assert_not_called()
     patched_BQWorker_enqueue.assert_called_once()
     self.assertEqual(patched_BQWorker_enqueue.call_args[0][0], 'BQWaiter')
-    self.assertIsInstance(patched_BQWorker_enqueue.call_args[0][1], dict)
+    self.assertEqual(patched_BQWorker_enqueue.call_args[0][1]['job_names'],
+                     [job0.name])
+    self.assertEqual(
+        patched_BQWorker_enqueue.call_args[0][1]['bq_project_id'], 'BQID')
+
+  def test_poll_delay_grows_with_job_running_time(self):
+    worker = workers.BQWorker({}, 1, 1)
+    job0 = mock.Mock()
+    job0.started = None
+    self.assertEqual(worker._get_poll_delay([job0]), worker.MIN_POLL_DELAY)
+    job0.started = datetime.utcnow() - timedelta(seconds=120)
+    self.assertAlmostEqual(worker._get_poll_delay([job0]), 60, delta=1)
+    job0.started = datetime.utcnow() - timedelta(hours=1)
+    self.assertEqual(worker._get_poll_delay([job0]), worker.MAX_POLL_DELAY)
 
 
 class TestBQWaiter(unittest.TestCase):
 
+  def setUp(self):
+    super(TestBQWaiter, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    super(TestBQWaiter, self).tearDown()
+    self.testbed.deactivate()
+
   def test_execute_enqueue_job_if_done(self):
     patcher_get_client = mock.patch.object(workers.BQWaiter, '_get_client',
         return_value=None)
@@ -193,6 +358,90 @@ class TestBQWaiter(unittest.TestCase):
     patched_enqueue.assert_called_once()
     self.assertEqual(patched_enqueue.call_args[0][0], 'BQWaiter')
 
+  @mock.patch('cloudstorage.delete')
+  @mock.patch('google.cloud.bigquery.job._AsyncJob')
+  def test_staged_files_are_deleted_once_jobs_are_done(self, patched_job,
+                                                       patched_delete):
+    patched_delete.__name__ = 'delete'
+    patched_job.return_value.error_result = None
+    patched_job.return_value.state = 'DONE'
+    worker = workers.BQWaiter(
+        {
+            'bq_project_id': 'BQID',
+            'job_names': ['Job1'],
+            'staged_uris': ['gs://bucket/staging/job.json'],
+        },
+        1,
+        1)
+    with mock.patch.object(worker, '_get_client'):
+      worker._execute()
+    patched_delete.assert_called_once_with('/bucket/staging/job.json')
+    self.assertEqual(worker._workers_to_enqueue, [])
+
+
+class TestStorageCleaner(unittest.TestCase):
+
+  def setUp(self):
+    super(TestStorageCleaner, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    patcher_listbucket = mock.patch('cloudstorage.listbucket')
+    patched_listbucket = patcher_listbucket.start()
+    self.addCleanup(patcher_listbucket.stop)
+    filenames = ['/bucket/a/%i.csv' % i for i in xrange(25)]
+    filenames += ['/bucket/b/%i.csv' % i for i in xrange(5)]
+    patched_listbucket.return_value = [
+        cloudstorage.GCSFileStat(f, 0, '686897696a7c876b7e', 0)
+        for f in filenames]
+    patcher_delete = mock.patch('cloudstorage.delete')
+    self.patched_delete = patcher_delete.start()
+    self.addCleanup(patcher_delete.stop)
+    self.patched_delete.__name__ = 'delete'
+
+  def tearDown(self):
+    super(TestStorageCleaner, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_expired_files_are_deleted(self):
+    worker = workers.StorageCleaner({'file_uris': ['gs://bucket/*.csv']}, 1, 1)
+    with mock.patch.object(worker, 'log_info') as patched_log_info:
+      worker._execute()
+    self.assertEqual(self.patched_delete.call_count, 30)
+    self.assertEqual(worker._workers_to_enqueue, [])
+    self.assertEqual(
+        [c[0][1:] for c in patched_log_info.call_args_list],
+        [(25, '/bucket/a'), (5, '/bucket/b')])
+
+  def test_continuation_is_enqueued_for_many_files(self):
+    worker = workers.StorageCleaner({'file_uris': ['gs://bucket/*.csv']}, 1, 1)
+    worker.MAX_DELETES_PER_TASK = 20
+    worker._execute()
+    self.assertEqual(self.patched_delete.call_count, 20)
+    self.assertEqual(len(worker._workers_to_enqueue), 1)
+    self.assertEqual(worker._workers_to_enqueue[0][0], 'StorageCleaner')
+
+  def test_files_deleted_before_a_failure_are_logged(self):
+    def _delete(filename):
+      if filename == '/bucket/a/3.csv':
+        raise ValueError(filename)
+    self.patched_delete.side_effect = _delete
+    worker = workers.StorageCleaner({'file_uris': ['gs://bucket/*.csv']}, 1, 1)
+    with mock.patch.object(worker, 'log_info') as patched_log_info:
+      with self.assertRaises(ValueError):
+        worker._execute()
+    self.assertEqual(
+        [c[0][1:] for c in patched_log_info.call_args_list],
+        [(9, '/bucket/a')])
+
+  def test_files_deleted_already_are_skipped(self):
+    self.patched_delete.side_effect = cloudstorage.NotFoundError()
+    worker = workers.StorageCleaner({'file_uris': ['gs://bucket/*.csv']}, 1, 1)
+    with mock.patch.object(worker, 'log_info') as patched_log_info:
+      worker._execute()
+    patched_log_info.assert_not_called()
+
 
 class TestStorageToBQImporter(unittest.TestCase):
 
@@ -208,24 +457,24 @@ class TestStorageToBQImporter(unittest.TestCase):
     self.testbed.init_datastore_v3_stub()
 
     patcher_listbucket = mock.patch('cloudstorage.listbucket')
-    patched_listbucket = patcher_listbucket.start()
+    self.patched_listbucket = patcher_listbucket.start()
     self.addCleanup(patcher_listbucket.stop)
-    def _fake_listbucket(bucket_prefix):
+    def _fake_listbucket(path_prefix):
       filenames = [
-        'input.csv',
-        'subdir/input.csv',
-        'data.csv',
-        'subdir/data.csv',
+        '/bucket/input.csv',
+        '/bucket/subdir/input.csv',
+        '/bucket/data.csv',
+        '/bucket/subdir/data.csv',
       ]
-      for suffix in filenames:
-        filename = os.path.join(bucket_prefix, suffix)
-        stat = cloudstorage.GCSFileStat(
-            filename,
-            0,
-            '686897696a7c876b7e',
-            0)
-        yield stat
-    patched_listbucket.side_effect = _fake_listbucket
+      for filename in filenames:
+        if filename.startswith(path_prefix):
+          stat = cloudstorage.GCSFileStat(
+              filename,
+              0,
+              '686897696a7c876b7e',
+              0)
+          yield stat
+    self.patched_listbucket.side_effect = _fake_listbucket
 
   def tearDown(self):
     super(TestStorageToBQImporter, self).tearDown()
@@ -260,6 +509,200 @@ class TestStorageToBQImporter(unittest.TestCase):
     self.assertEqual(source_uris[0], 'gs://bucket/subdir/input.csv')
     self.assertEqual(source_uris[1], 'gs://bucket/subdir/data.csv')
 
+  def test_listing_is_limited_to_literal_prefixes(self):
+    worker = workers.StorageToBQImporter(
+      {
+        'source_uris': [
+          'gs://bucket/subdir/*.csv',
+          'gs://bucket/subdir/data.csv',
+          'gs://bucket/d*.csv',
+        ]
+      },
+      1,
+      1)
+    source_uris = worker._get_source_uris()
+    self.assertEqual(sorted(source_uris), [
+        'gs://bucket/data.csv',
+        'gs://bucket/subdir/data.csv',
+        'gs://bucket/subdir/input.csv',
+    ])
+    self.assertEqual(
+        sorted(c[0][0] for c in self.patched_listbucket.call_args_list),
+        ['/bucket/d', '/bucket/subdir/'])
+
+
+class TestGAToBQImporter(unittest.TestCase):
+
+  def setUp(self):
+    super(TestGAToBQImporter, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    self.staging_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.staging_dir)
+
+  def tearDown(self):
+    super(TestGAToBQImporter, self).tearDown()
+    self.testbed.deactivate()
+
+  def _make_worker(self, params):
+    worker_params = {
+        'view_ids': ['123'],
+        'metrics': ['ga:users'],
+        'dimensions': ['ga:source'],
+    }
+    worker_params.update(params)
+    worker = workers.GAToBQImporter(worker_params, 1, 1)
+    worker._job_name = 'job'
+    worker._client = mock.Mock()
+    worker._table = mock.Mock()
+    worker._table.schema = [
+        SchemaField('view_id', 'STRING'),
+        SchemaField('ga_source', 'STRING'),
+        SchemaField('ga_users', 'STRING'),
+    ]
+    worker._ga_client = mock.Mock()
+    execute = worker._ga_client.reports().batchGet().execute
+    # NB: functools.wraps used by the retry method needs a function name.
+    execute.__name__ = 'execute'
+    execute.return_value = {
+        'reports': [{
+            'columnHeader': {
+                'dimensions': ['ga:source'],
+                'metricHeader': {
+                    'metricHeaderEntries': [{'name': 'ga:users'}],
+                },
+            },
+            'data': {'rows': [
+                {'dimensions': ['google'], 'metrics': [{'values': ['10']}]},
+                {'dimensions': ['bing'], 'metrics': [{'values': ['2']}]},
+            ]},
+        }],
+    }
+    worker._compose_report()
+    worker._bq_rows = []
+    return worker
+
+  @mock.patch('core.workers.GAToBQImporter._wait')
+  def test_rows_are_staged_and_loaded_with_one_job(self, patched_wait):
+    worker = self._make_worker({'staging_uri': 'gs://bucket/staging/'})
+    deferrable = []
+    patched_wait.side_effect = lambda *_: deferrable.append(worker._deferrable)
+    staging_path = os.path.join(self.staging_dir, 'rows.json')
+    worker._open_staging_file = lambda uri: open(staging_path, 'w')
+    worker._stage()
+    self.assertTrue(worker._get_reports('2018-01-01', '2018-01-01'))
+    with open(staging_path) as f:
+      rows = [json.loads(line) for line in f]
+    self.assertEqual(rows, [
+        {'view_id': '123', 'ga_source': 'google', 'ga_users': '10'},
+        {'view_id': '123', 'ga_source': 'bing', 'ga_users': '2'},
+    ])
+    worker._client.load_table_from_storage.assert_called_once_with(
+        'job', worker._table, 'gs://bucket/staging/job.json')
+    job = worker._client.load_table_from_storage.return_value
+    self.assertEqual(job.source_format, 'NEWLINE_DELIMITED_JSON')
+    job.begin.assert_called_once_with()
+    patched_wait.assert_called_once_with(
+        [job], ['gs://bucket/staging/job.json'])
+    # A deferral while waiting would load the rows again.
+    self.assertEqual(deferrable, [False])
+    worker._table.insert_data.assert_not_called()
+    self.assertEqual(worker._checkpoint['view_index'], 1)
+
+  def test_page_size_depends_on_report_width(self):
+    worker = self._make_worker({})
+    self.assertEqual(worker._request['pageSize'], 100000)
+    worker = self._make_worker({
+        'dimensions': ['ga:dimension%i' % i for i in xrange(1, 10)],
+        'metrics': ['ga:metric%i' % i for i in xrange(1, 11)],
+    })
+    self.assertEqual(worker._request['pageSize'], 26315)
+
+  @mock.patch('core.workers.GAToBQImporter._bq_setup')
+  def test_day_by_day_range_is_split_in_shards(self, patched_bq_setup):
+    worker = self._make_worker({
+        'day_by_day': True,
+        'start_date': '2018-01-01',
+        'end_date': '2018-01-10',
+        'parallel_shards': 3,
+    })
+    worker._execute()
+    patched_bq_setup.assert_not_called()
+    shards = [(w[1]['start_date'], w[1]['end_date'], w[1]['parallel_shards'])
+              for w in worker._workers_to_enqueue]
+    self.assertEqual(shards, [
+        ('2018-01-01', '2018-01-04', 1),
+        ('2018-01-05', '2018-01-07', 1),
+        ('2018-01-08', '2018-01-10', 1),
+    ])
+
+  def test_shards_are_capped_by_days_count(self):
+    worker = self._make_worker({'parallel_shards': 10})
+    start_date = datetime(2018, 1, 1).date()
+    self.assertTrue(worker._enqueue_shards(start_date,
+                                           start_date + timedelta(1)))
+    self.assertEqual(len(worker._workers_to_enqueue), 2)
+    self.assertFalse(worker._enqueue_shards(start_date, start_date))
+
+  def test_projector_converts_values_to_field_types(self):
+    worker = self._make_worker({})
+    worker._table.schema = [
+        SchemaField('ga_date', 'DATE'),
+        SchemaField('ga_users', 'INTEGER'),
+        SchemaField('ga_bounceRate', 'FLOAT'),
+        SchemaField('view_id', 'INTEGER'),
+        SchemaField('ga_source', 'STRING'),
+    ]
+    column_header = {
+        'dimensions': ['ga:date'],
+        'metricHeader': {
+            'metricHeaderEntries': [{'name': 'ga:users'},
+                                    {'name': 'ga:bounceRate'}],
+        },
+    }
+    project = worker._compile_projector(column_header, '123', '2018-01-01',
+                                        '2018-01-31')
+    rows = project([
+        {'dimensions': ['20180101'], 'metrics': [{'values': ['10', '0.5']}]},
+        {'dimensions': ['20180102'], 'metrics': [{'values': ['2', '1']}]},
+    ])
+    self.assertEqual(rows, [
+        ('2018-01-01', 10, 0.5, 123, None),
+        ('2018-01-02', 2, 1.0, 123, None),
+    ])
+
+  def test_rows_are_streamed_without_staging_uri(self):
+    worker = self._make_worker({})
+    worker._stage()
+    self.assertTrue(worker._get_reports('2018-01-01', '2018-01-01'))
+    worker._table.insert_data.assert_called_once_with([
+        ('123', 'google', '10'),
+        ('123', 'bing', '2'),
+    ])
+    worker._client.load_table_from_storage.assert_not_called()
+
+
+class TestGADataImporter(unittest.TestCase):
+
+  def test_worker_is_not_deferred_after_upload(self):
+    worker = workers.GADataImporter({
+        'csv_uri': 'gs://bucket/data.csv',
+        'property_id': 'UA-12345-3',
+        'dataset_id': 'sLj2CuBTDFy6CedBJw',
+        'max_uploads': 2,
+        'delete_before': False,
+    }, 1, 1)
+    worker._ga_setup = mock.Mock()
+    worker._upload = mock.Mock()
+    deferrable = []
+    worker._delete_older = mock.Mock(
+        side_effect=lambda _: deferrable.append(worker._deferrable))
+    worker._execute()
+    worker._delete_older.assert_called_once_with(2)
+    self.assertEqual(deferrable, [False])
+
 
 class TestBQToMeasurementProtocolMixin(object):
 
@@ -280,6 +723,11 @@ class TestBQToMeasurementProtocolProcessor(TestBQToMeasurementProtocolMixin, uni
 
   def setUp(self):
     super(TestBQToMeasurementProtocolProcessor, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    self.addCleanup(self.testbed.deactivate)
 
     self._client = mock.Mock()
     patcher_get_client = mock.patch.object(
@@ -289,10 +737,63 @@ class TestBQToMeasurementProtocolProcessor(TestBQToMeasurementProtocolMixin, uni
     self.addCleanup(patcher_get_client.stop)
     patcher_get_client.start()
 
-    patcher_requests_post = mock.patch('requests.post')
+    patcher_requests_post = mock.patch('requests.Session.post')
     self.addCleanup(patcher_requests_post.stop)
     self._patched_post = patcher_requests_post.start()
 
+  def test_process_query_results_continues_when_out_of_time(self):
+    worker = workers.BQToMeasurementProtocolProcessor(
+        {'mp_batch_size': 1}, 1, 1)
+    worker.MP_MAX_IN_FLIGHT = 1
+    worker._deadline = 0
+    field = mock.Mock()
+    field.name = 'cid'
+    with mock.patch.object(worker, '_send_batch') as patched_send:
+      worker._process_query_results([('1',), ('2',), ('3',)], [field])
+    patched_send.assert_called_once()
+    self.assertEqual(len(worker._workers_to_enqueue), 1)
+    worker_class, params, _ = worker._workers_to_enqueue[0]
+    self.assertEqual(worker_class, 'BQToMeasurementProtocolProcessor')
+    self.assertEqual(params['_checkpoint'], {'rows_sent': 1})
+
+  def test_process_query_results_resumes_from_checkpoint(self):
+    worker = workers.BQToMeasurementProtocolProcessor(
+        {'mp_batch_size': 1}, 1, 1)
+    worker.resume({'rows_sent': 2})
+    field = mock.Mock()
+    field.name = 'cid'
+    with mock.patch.object(worker, '_send_batch') as patched_send:
+      worker._process_query_results([('1',), ('2',), ('3',)], [field])
+    patched_send.assert_called_once_with('v=1&cid=3')
+
+  def test_process_query_results_sends_batches_concurrently(self):
+    worker = workers.BQToMeasurementProtocolProcessor(
+        {'mp_batch_size': 2}, 1, 1)
+    worker.MP_MAX_IN_FLIGHT = 2
+    field = mock.Mock()
+    field.name = 'cid'
+    rows = [(str(i),) for i in xrange(5)]
+    with mock.patch.object(worker, '_send_batch') as patched_send:
+      worker._process_query_results(rows, [field])
+    self.assertEqual(sorted(c[0][0] for c in patched_send.call_args_list), [
+        'v=1&cid=0\nv=1&cid=1',
+        'v=1&cid=2\nv=1&cid=3',
+        'v=1&cid=4',
+    ])
+    self.assertFalse(worker._deferrable)
+
+  def test_process_query_results_rejects_oversized_hits(self):
+    worker = workers.BQToMeasurementProtocolProcessor(
+        {'mp_batch_size': 20}, 1, 1)
+    field = mock.Mock()
+    field.name = 'el'
+    rows = [('a' * 9000,), ('b',)]
+    with mock.patch.object(worker, '_send_batch') as patched_send, \
+        mock.patch.object(worker, '_reject_hits') as patched_reject:
+      worker._process_query_results(rows, [field])
+    patched_send.assert_called_once_with('v=1&el=b')
+    self.assertEqual(patched_reject.call_args[0][0], 1)
+
   @mock.patch('time.sleep')
   def test_success_with_one_post_request(self, patched_time_sleep):
     # Bypass the time.sleep wait
@@ -302,7 +803,7 @@ class TestBQToMeasurementProtocolProcessor(TestBQToMeasurementProtocolMixin, uni
             'bq_project_id': 'BQID',
             'bq_dataset_id': 'DTID',
             'bq_table_id': 'table_id',
-            'bq_page_token': None,
+            'bq_start_index': 0,
             'bq_batch_size': 10,
             'mp_batch_size': 20,
         },
@@ -363,6 +864,9 @@ class TestBQToMeasurementProtocolProcessor(TestBQToMeasurementProtocolMixin, uni
     self._patched_post.return_value = mock_response
 
     self._worker._execute()
+    self.assertEqual(
+        self._client._connection.api_request.call_args[1]['query_params'],
+        {'startIndex': 0, 'maxResults': 10})
     self._patched_post.assert_called_once()
     self.assertEqual(
         self._patched_post.call_args[0][0],
@@ -371,9 +875,10 @@ class TestBQToMeasurementProtocolProcessor(TestBQToMeasurementProtocolMixin, uni
         self._patched_post.call_args[1],
         {
             'headers': {'user-agent': 'CRMint / 0.1'},
+            'timeout': 30,
             'data':
-"""ni=1.0&el=label&cid=35009a79-1a05-49d7-b876-2b884d0f825b&ea=action&ec=category&t=event&v=1&tid=UA-12345-1&ev=0.9&ua=User+Agent+%2F+1.0
-ni=1.0&el=label&cid=35009a79-1a05-49d7-b876-2b884d0f825b&ea=action&ec=category&t=event&v=1&tid=UA-12345-1&ev=0.8&ua=User+Agent+%2F+1.0""",
+"""v=1&tid=UA-12345-1&cid=35009a79-1a05-49d7-b876-2b884d0f825b&t=event&ni=1.0&ec=category&ea=action&el=label&ev=0.9&ua=User+Agent+%2F+1.0
+v=1&tid=UA-12345-1&cid=35009a79-1a05-49d7-b876-2b884d0f825b&t=event&ni=1.0&ec=category&ea=action&el=label&ev=0.8&ua=User+Agent+%2F+1.0""",
         })
 
   @mock.patch('core.logging.logger')
@@ -390,7 +895,7 @@ ni=1.0&el=label&cid=35009a79-1a05-49d7-b876-2b884d0f825b&ea=action&ec=category&t
             'bq_project_id': 'BQID',
             'bq_dataset_id': 'DTID',
             'bq_table_id': 'table_id',
-            'bq_page_token': None,
+            'bq_start_index': 0,
             'bq_batch_size': 10,
             'mp_batch_size': 20,
         },
@@ -437,17 +942,77 @@ ni=1.0&el=label&cid=35009a79-1a05-49d7-b876-2b884d0f825b&ea=action&ec=category&t
     mock_response.status_code = 500
     self._patched_post.return_value = mock_response
 
-    self._worker._execute()
+    with mock.patch.object(self._worker, '_spool') as patched_spool:
+      self._worker._execute()
     # Called 2 times because of 1 retry.
     self.assertEqual(self._patched_post.call_count, 2)
-    # When retry stops it should log the message as an error.
+    # When retry stops the batch should be spooled to be resent.
+    failed_batches = patched_spool.call_args[0][0]
+    self.assertEqual(len(failed_batches), 1)
+    self.assertEqual(failed_batches[0][1], 'http_500')
     patched_logger.log_error.called_once()
 
+  def _execute_on_range(self, start_index, rows_count):
+    self._worker = workers.BQToMeasurementProtocolProcessor(
+        {
+            'bq_project_id': 'BQID',
+            'bq_dataset_id': 'DTID',
+            'bq_table_id': 'table_id',
+            'bq_start_index': start_index,
+            'bq_batch_size': 2,
+            'bq_rows_count': rows_count,
+            'mp_batch_size': 20,
+        },
+        1,
+        1)
+    # Rows streamed in after the table metadata was read come with a page
+    # token past any range.
+    self._use_query_results({
+        'tableReference': {
+            'tableId': 'mock_table',
+        },
+        'jobReference': {
+            'jobId': 'table',
+        },
+        'numRows': '2',
+        'pageToken': 'abc',
+        'rows': [
+            {'f': [{'v': 'c1'}]},
+        ],
+        'schema': {
+            'fields': [
+                {'name': 'cid', 'type': 'STRING'},
+            ]
+        }
+    })
+    with mock.patch.object(self._worker, '_send_batch') as patched_send:
+      patched_send.return_value = None
+      self._worker._execute()
+    self.assertEqual(patched_send.call_args[0][0], 'v=1&cid=c1\nv=1&cid=c1')
+    return self._worker._workers_to_enqueue
+
+  def test_last_range_reads_on_to_the_end_of_the_table(self):
+    enqueued = self._execute_on_range(2, 4)
+    self.assertEqual(
+        self._client._connection.api_request.call_args[1]['query_params'],
+        {'startIndex': 3, 'maxResults': 1})
+    self.assertEqual(len(enqueued), 1)
+    self.assertEqual(enqueued[0][0], 'BQToMeasurementProtocolProcessor')
+    self.assertEqual(enqueued[0][1]['bq_start_index'], 4)
+    self.assertEqual(enqueued[0][1]['bq_rows_count'], 6)
+
+  def test_other_ranges_spawn_no_processor(self):
+    self.assertEqual(self._execute_on_range(0, 4), [])
+
 
 class TestBQToMeasurementProtocol(TestBQToMeasurementProtocolMixin, unittest.TestCase):
 
   def setUp(self):
     super(TestBQToMeasurementProtocol, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
 
     self._client = mock.Mock()
     patcher_get_client = mock.patch.object(
@@ -457,85 +1022,142 @@ class TestBQToMeasurementProtocol(TestBQToMeasurementProtocolMixin, unittest.Tes
     self.addCleanup(patcher_get_client.stop)
     patcher_get_client.start()
 
-  @mock.patch('time.sleep')
-  def test_success_with_spawning_new_worker(self, patched_time_sleep):
-    # Bypass the time.sleep wait
-    patched_time_sleep.return_value = 1
+  def tearDown(self):
+    super(TestBQToMeasurementProtocol, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_processors_are_enqueued_for_row_ranges(self):
     self._worker = workers.BQToMeasurementProtocol(
         {
             'bq_project_id': 'BQID',
             'bq_dataset_id': 'DTID',
             'bq_table_id': 'table_id',
-            'bq_page_token': None,
             'mp_batch_size': 20,
         },
         1,
         1)
-    self._worker.MAX_ENQUEUED_JOBS = 1
-    api_response = {
+    self._worker.BQ_BATCH_SIZE = 10
+    self._use_query_results({
         'tableReference': {
             'tableId': 'mock_table',
         },
         'jobReference': {
-            'jobId': 'one-row-query',
+            'jobId': 'table',
         },
-        'pageToken': 'abc',
-        'rows': [
-            {
-                'f': [
-                    {'v': 'UA-12345-1'},
-                    {'v': '35009a79-1a05-49d7-b876-2b884d0f825b'},
-                    {'v': 'event'},
-                    {'v': 1},
-                    {'v': 'category'},
-                    {'v': 'action'},
-                    {'v': 'label'},
-                    {'v': 0.9},
-                    {'v': 'User Agent / 1.0'},
-                ]
-            },
-            {
-                'f': [
-                    {'v': 'UA-12345-1'},
-                    {'v': '35009a79-1a05-49d7-b876-2b884d0f825b'},
-                    {'v': 'event'},
-                    {'v': 1},
-                    {'v': 'category'},
-                    {'v': 'action'},
-                    {'v': 'label'},
-                    {'v': 0.8},
-                    {'v': 'User Agent / 1.0'},
-                ]
-            },
-        ],
+        'numRows': '25',
         'schema': {
             'fields': [
-                {'name': 'tid', 'type': 'STRING'},
                 {'name': 'cid', 'type': 'STRING'},
-                {'name': 't', 'type': 'STRING'},
-                {'name': 'ni', 'type': 'FLOAT'},
-                {'name': 'ec', 'type': 'STRING'},
-                {'name': 'ea', 'type': 'STRING'},
-                {'name': 'el', 'type': 'STRING'},
-                {'name': 'ev', 'type': 'FLOAT'},
-                {'name': 'ua', 'type': 'STRING'},
             ]
         }
-    }
-    self._use_query_results(api_response)
+    })
+    self._worker._execute()
+    self.assertEqual(
+        [(w[0], w[1]['bq_start_index'], w[1]['bq_batch_size'],
+          w[1]['bq_rows_count'])
+         for w in self._worker._workers_to_enqueue],
+        [
+            ('BQToMeasurementProtocolProcessor', 0, 10, 25),
+            ('BQToMeasurementProtocolProcessor', 10, 10, 25),
+            ('BQToMeasurementProtocolProcessor', 20, 10, 25),
+        ])
 
-    patcher_worker_enqueue = mock.patch.object(workers.BQToMeasurementProtocol, '_enqueue')
-    self.addCleanup(patcher_worker_enqueue.stop)
-    patched_enqueue = patcher_worker_enqueue.start()
-    def _remove_next_page_token(worker_name, *args, **kwargs):
-      if worker_name == 'BQToMeasurementProtocol':
-        del api_response['pageToken']
-        self._use_query_results(api_response)
-    patched_enqueue.side_effect = _remove_next_page_token
+  def test_empty_table_gets_a_processor_for_streamed_rows(self):
+    self._worker = workers.BQToMeasurementProtocol(
+        {
+            'bq_project_id': 'BQID',
+            'bq_dataset_id': 'DTID',
+            'bq_table_id': 'table_id',
+            'mp_batch_size': 20,
+        },
+        1,
+        1)
+    self._use_query_results({
+        'tableReference': {
+            'tableId': 'mock_table',
+        },
+        'jobReference': {
+            'jobId': 'table',
+        },
+        'numRows': '0',
+        'schema': {
+            'fields': [
+                {'name': 'cid', 'type': 'STRING'},
+            ]
+        }
+    })
+    self._worker._execute()
+    enqueued = self._worker._workers_to_enqueue
+    self.assertEqual(len(enqueued), 1)
+    self.assertEqual(enqueued[0][1]['bq_start_index'], 0)
+    self.assertEqual(enqueued[0][1]['bq_rows_count'], 0)
 
+  def test_remaining_ranges_are_scheduled_by_a_new_task(self):
+    self._worker = workers.BQToMeasurementProtocol(
+        {
+            'bq_project_id': 'BQID',
+            'bq_dataset_id': 'DTID',
+            'bq_table_id': 'table_id',
+            'mp_batch_size': 20,
+            'bq_start_index': 10,
+        },
+        1,
+        1)
+    self._worker.BQ_BATCH_SIZE = 10
+    self._worker.MAX_RANGES_PER_TASK = 1
+    self._use_query_results({
+        'tableReference': {
+            'tableId': 'mock_table',
+        },
+        'jobReference': {
+            'jobId': 'table',
+        },
+        'numRows': '35',
+        'schema': {
+            'fields': [
+                {'name': 'cid', 'type': 'STRING'},
+            ]
+        }
+    })
     self._worker._execute()
-    self.assertEqual(patched_enqueue.call_count, 2)
-    self.assertEqual(patched_enqueue.call_args_list[0][0][0], 'BQToMeasurementProtocolProcessor')
-    self.assertEqual(patched_enqueue.call_args_list[0][0][1]['bq_page_token'], None)
-    self.assertEqual(patched_enqueue.call_args_list[1][0][0], 'BQToMeasurementProtocol')
-    self.assertEqual(patched_enqueue.call_args_list[1][0][1]['bq_page_token'], 'abc')
+    enqueued = self._worker._workers_to_enqueue
+    self.assertEqual(len(enqueued), 2)
+    self.assertEqual(enqueued[0][0], 'BQToMeasurementProtocolProcessor')
+    self.assertEqual(enqueued[0][1]['bq_start_index'], 10)
+    self.assertEqual(enqueued[1][0], 'BQToMeasurementProtocol')
+    self.assertEqual(enqueued[1][1]['bq_start_index'], 20)
+    self.assertEqual(enqueued[1][1]['bq_rows_count'], 35)
+
+
+class TestMeasurementProtocolReplayer(utils.ModelTestCase):
+
+  def setUp(self):
+    super(TestMeasurementProtocolReplayer, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    models.SpooledBatch.spool(1, 1, [
+        ('v=1&cid=1\nv=1&cid=2', 'http_500'),
+        ('v=1&cid=3', 'timeout'),
+    ])
+    models.SpooledBatch.spool(2, 3, [('v=1&cid=4', 'http_500')])
+
+  def tearDown(self):
+    super(TestMeasurementProtocolReplayer, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_spooled_batches_of_pipeline_are_resent(self):
+    worker = workers.MeasurementProtocolReplayer({}, 1, 2)
+    def _send_batch(payload):
+      return 'http_500' if payload == 'v=1&cid=3' else None
+    with mock.patch.object(worker, '_send_batch',
+                           side_effect=_send_batch) as patched_send:
+      worker._execute()
+    self.assertEqual(patched_send.call_count, 2)
+    spooled_batches = models.SpooledBatch.where(pipeline_id=1).all()
+    self.assertEqual(len(spooled_batches), 1)
+    self.assertEqual(spooled_batches[0].payload, 'v=1&cid=3')
+    self.assertEqual(spooled_batches[0].reason, 'http_500')
+    self.assertEqual(spooled_batches[0].attempts, 2)
+    self.assertEqual(models.SpooledBatch.where(pipeline_id=2).count(), 1)
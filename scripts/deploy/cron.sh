@@ -14,12 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-# ------------------------- DEPLOY CRON ------------------------
+# ------------------------- DEPLOY CRON & QUEUES ------------------------
 echo
-echo -e "$BLUE==>$NONE$BOLD CRON deploy is started$NONE"
+echo -e "$BLUE==>$NONE$BOLD CRON & queues deploy is started$NONE"
 cd $workdir/backends
 
-# Deploy CRON
-$gcloud_sdk_dir/bin/gcloud --quiet --project $project_id_gae app deploy cron.yaml
+# Deploy CRON & queues
+$gcloud_sdk_dir/bin/gcloud --quiet --project $project_id_gae app deploy cron.yaml queue.yaml
 
-# ------------------------- END DEPLOY CRON --------------------
+# ------------------------- END DEPLOY CRON & QUEUES --------------------